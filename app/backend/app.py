@@ -1,22 +1,38 @@
+import os
 import json
 import base64
+import asyncio
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
 import scipy as sp
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-
-from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
 
 import model as m
 
+from model import Settings
+
 import image as i
 
 import functions as f
 
+import cache as c
+
+import render as r
+
+import binary as b
+
+import tiles as t
+
+import neighbors as n
+
 
 origins = [
     'http://localhost',
@@ -34,229 +50,258 @@ app.add_middleware(
 )
 
 
-cache = {}
-def load_file(file_name):
-    if file_name in cache:
-        data = cache[file_name]
+render_cache_budget = int(os.environ.get('RENDER_CACHE_MB', 512)) * 1024 * 1024
+render_cache = c.LRUCache('renders', max_bytes=render_cache_budget, spill_path=os.environ.get('RENDER_CACHE_DIR') or None)
+
+
+# rendering runs in RENDER_WORKERS worker processes, 0 renders in a thread of
+# this process, either way the event loop stays free for other requests
+render_workers = int(os.environ.get('RENDER_WORKERS', 0))
+render_pool = None
+
+# how often a waiting request checks whether its client is still connected
+disconnect_poll_interval = 0.1
+
+
+async def run_rendering(request, fn, *args):
+    if render_pool is None:
+        future = asyncio.ensure_future(run_in_threadpool(fn, *args))
     else:
-        data = m.parse_JSON_file(file_name)
-    return data
+        future = asyncio.get_running_loop().run_in_executor(render_pool, fn, *args)
 
+    while True:
+        done, _ = await asyncio.wait([future], timeout=disconnect_poll_interval)
+        if done:
+            break
+        if request is not None and await request.is_disconnected():
+            # drops the job if no worker picked it up yet, a running job is finished and discarded
+            future.cancel()
+            print(f'Client disconnected, cancelled {fn.__name__}')
+            raise HTTPException(status_code=499, detail='Client disconnected')
 
-json_files = m.get_all_available_JSON_files()
-print(f'Base data files: {", ".join(json_files)}')
+    return future.result()
 
-finished_pre_loading = False
 
+def check_file(file_name):
+    if file_name not in data_files:
+        raise HTTPException(status_code=404, detail=f'Dataset {file_name} not found')
 
-class Settings(BaseModel):
-    resolution_width: int = 0
-    resolution_height: int = 0
-    
-    layout: str = 'vertical'
-
-    raw_data: bool = True
-    raw_data_histogram: bool = False
-    activations: bool = True
-    activations_histogram: bool = False
-    attributions: bool = True
-    attributions_histogram: bool = False
-    labels_pred: bool = True
-    
-    suggestions: bool = False
-    
-    raw_time_series_colormap: str = 'interpolateRdBu'
-    raw_time_series_histogram_colormap: str = 'interpolateReds'
 
-    activations_colormap: str = 'interpolateReds'
-    activations_histogram_colormap: str = 'interpolateReds'
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('if-none-match', '')
+    tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+    return etag in tags or '*' in tags
 
-    attributions_colormap: str = 'interpolateRdBu'
-    attributions_histogram_colormap: str = 'interpolateReds'
 
-    predictions_colormap: str = 'viridis'
+data_files = m.get_all_available_files()
+print(f'Base data files: {", ".join(data_files)}')
+
+finished_pre_loading = False
 
 
 @app.on_event('startup')
 async def startup_event():
-    global cache
-    global finished_pre_loading
-    
-    for json_file in json_files:
-        cache[json_file[:-5]] = m.parse_JSON_file(json_file)
+    global finished_pre_loading, render_pool
 
-    print(f'Finished loading the files: {", ".join(cache.keys())}')
+    # convert JSON datasets here once, so workers never convert the same file at the same time,
+    # the datasets themselves are opened lazily on their first request in load_file
+    for file_name in data_files:
+        await run_in_threadpool(m.prepare_file, file_name)
+
+    if render_workers > 0:
+        # spawned workers only import the rendering modules, not this app
+        render_pool = ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context('spawn'))
+        print(f'Rendering in {render_workers} worker processes')
+
+    print(f'Ready to serve the files: {", ".join(data_files)}')
     finished_pre_loading = True
 
 
+@app.on_event('shutdown')
+async def shutdown_event():
+    if render_pool is not None:
+        render_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def meta_to_json(meta):
+    return {
+        **meta,
+        'summary_data': {k: v.tolist() for k, v in meta['summary_data'].items()},
+        'ordering_idc': meta['ordering_idc'].tolist(),
+    }
+
+
+response_formats = ['json', 'png', 'rgba']
+
+
 @app.post('/api/getPixelImage')
 @app.post('/api/getPixelImage/')
 @app.post('/api/getPixelImage/{file_name}')
-async def serve_image(settings: Settings, file_name: str = '', start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
-    
+async def serve_image(request: Request, response: Response, settings: Settings, file_name: str = '', start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = '', response_format: str = 'json'):
+    # json: base64 PNG with the meta data (default), png/rgba: the image as binary
+    # body, its meta data comes from /api/getPixelMeta with the same parameters
+
     if not finished_pre_loading:
-        raise HTTPException(status_code=5, detail='Data not loaded yet')
-    
+        raise HTTPException(status_code=503, detail='Data not loaded yet')
+
+    if response_format not in response_formats:
+        raise HTTPException(status_code=400, detail=f'Unknown response format {response_format}, use one of {", ".join(response_formats)}')
 
     if file_name == '':
         file_name = m.get_default_file_name()
-    
-    resolution_width = settings.resolution_width
-    resolution_height = settings.resolution_height
-
-    layout = settings.layout
-
-    settings_dict = settings.dict()
-    data_to_show = []
-    for k in settings_dict.keys():
-        if settings_dict[k] == True:
-            if 'labels' in k:
-                data_to_show.append('labels')
-                data_to_show.append('predictions')
-            else:
-                data_to_show.append(k)
-    
-    print(f'General settings: {settings}')
-    
-    loaded_data = load_file(file_name)
 
-    data = loaded_data.data
-    orderings = loaded_data.orderings
-    interestingness = loaded_data.interestingness
-    
-    if stage == '':
-        stage, _ = data.get_default()
-    
-    if ordering_base == '':
-        ordering_base, _ = data.get(stage).get_default()
+    image_format = 'rgba' if response_format == 'rgba' else 'png'
 
-    if ordering_method == '':
-        ordering_method, _ = orderings.get(stage).get_default(ordering_base)
+    # identical requests on the same version of a dataset render the same image
+    etag = f'"{c.make_key(file_name, m.get_file_fingerprint(file_name), start, end, stage, ordering_base, ordering_method, attribution_method, settings.dict(), response_format)}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
 
-    if attribution_method == '':
-        attribution_method, _ = data.get(stage).get_default_attribution()
+    # json and png responses share the rendered PNG
+    render_key = c.make_key(file_name, m.get_file_fingerprint(file_name), start, end, stage, ordering_base, ordering_method, attribution_method, settings.dict(), image_format)
+    rendered = render_cache.get(render_key)
+    if rendered is None:
+        check_file(file_name)
+        rendered = await run_rendering(request, r.render_pixel_image, settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method, image_format)
+        render_cache.put(render_key, rendered)
 
-    print(f'Dataset: {file_name}, Interval: [{start}, {end}], Stage: {stage}, Method: {attribution_method}, Ordering: [{ordering_base}, {ordering_method}]')
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
 
-    collected_data = m.parse_model_to_dict(data.get(stage))
-    collected_data['attributions_histogram'] = collected_data['attributions'][f'{attribution_method}_histogram']
-    collected_data['attributions'] = collected_data['attributions'][attribution_method]
+    if response_format == 'png':
+        return Response(content=rendered['image'], media_type='image/png', headers=headers)
 
-    orderings_defaults = orderings.get(stage).get_default_orderings()
-    orderings_defaults['attributions_histogram'] = orderings_defaults['attributions'][f'{attribution_method}_histogram']
-    orderings_defaults['attributions'] = orderings_defaults['attributions'][f'{attribution_method}']
-    orderings_defaults['None'] = ['None']
+    if response_format == 'rgba':
+        height, width, channels = rendered['shape']
+        headers.update({'X-Image-Width': str(width), 'X-Image-Height': str(height), 'X-Image-Channels': str(channels)})
+        return Response(content=rendered['image'], media_type=b.media_type, headers=headers)
 
-    selected_ordering = orderings.get(stage).get_orderings(ordering_base, ordering_method, attribution_method)
-    stages = data.get_set()
-    attribution_methods = data.get(stage).get_attributions()
+    response.headers.update(headers)
 
-    if selected_ordering is None:
-        ordering = np.array(range(len(collected_data[list(collected_data.keys())[0]])))
-    else:
-        ordering = selected_ordering['ordering']
-
-    print(f'Selected Ordering: {ordering}')
-
-    interestingness_idc = interestingness.get(stage).get_interestingness(ordering_base, ordering_method, attribution_method)
-    selected_interestingness_idc = []
-    if interestingness_idc:
-        for idx in interestingness_idc:
-            if start <= idx[0][0] and idx[0][1] <= end:
-                selected_interestingness_idc.append(idx)
-
-    # slice to start and end and calculate width
-    ret_tmp = {}
-    max_samples = 0
-    sliced_ordering = ordering[start:end]
-
-    for k in collected_data:
-        max_samples = max(max_samples, len(collected_data[k]))
-        ret_tmp[k] = collected_data[k][sliced_ordering].tolist()
-    sliced_ordering = sliced_ordering.tolist()
-
-    # summary data for the slider selector
-    summary_data_std = {}
-    for k in collected_data.keys():
-        tmp_data = collected_data[k][ordering]
-
-        if len(tmp_data.shape) > 1:
-            if tmp_data.shape[-1] > 10:
-                summary_data_std[k] = np.std(tmp_data, axis=1).tolist()
-            else:
-                summary_data_std[k] = np.mean(tmp_data, axis=1).tolist()
-        else:
-            summary_data_std[k] = tmp_data.copy().tolist()
-
-    summary_data_std['None'] = np.std(collected_data['raw_data'][ordering], axis=1).tolist()
-
-    data_generation = [
-        ['raw_data', 'MinMax', settings.raw_time_series_colormap, False],
-        ['raw_data_histogram', 'Sqrt', settings.raw_time_series_histogram_colormap, False],
-        ['activations', 'MinMax', settings.activations_colormap, False],
-        ['activations_histogram', 'Sqrt', settings.activations_histogram_colormap, False],
-        ['attributions', 'MinMax', settings.attributions_colormap, True],
-        ['attributions_histogram', 'Sqrt', settings.attributions_histogram_colormap, False],
-        ['labels', 'MinMax', settings.predictions_colormap, False],
-        ['predictions', 'MinMax', settings.predictions_colormap, False]
-    ]
-
-    data_for_image = []
-    proportion_for_image = []
-
-    for k in data_generation:
-        k, norm, cmap, quant = k
-        if k in ret_tmp and k in data_to_show:
-            d = np.array(ret_tmp[k])
-            # d = i.discretizer(d)
-            d = i.normalize(d, norm)
-            if quant:
-                d = i.only_quantiles(d)
-            d = i.data_to_color(d, cmap)
-
-            data_for_image.append(d)
-            if d.shape[1] > 10:
-                proportion_for_image.append(d.shape[1])
-
-    proportion_sum = sum(proportion_for_image)
-    if layout == 'horizontal':
-        proportion_for_image_scaled = [x/proportion_sum * resolution_height for x in proportion_for_image]
-    else:
-        proportion_for_image_scaled = [x/proportion_sum * resolution_width for x in proportion_for_image]
+    return {
+        'image': base64.b64encode(rendered['image']),
+        'meta': meta_to_json(rendered['meta']),
+    }
 
-    image = i.data_to_image(data_for_image, resolution=[resolution_width, resolution_height], direction=layout)
-    image_base64 = base64.b64encode(image.read())
-    
-    ret_tmp = {
-       'image': image_base64,
-       'meta': {
-            'stages': stages,
-            'attribution_methods': attribution_methods,
-            'orderings': orderings_defaults,
 
-            'cur_stage': stage,
-            'cur_attribution_method': attribution_method,
-            'cur_ordering_base': ordering_base,
-            'cur_ordering_method': ordering_method,
+@app.get('/api/getPixelImage')
+@app.get('/api/getPixelImage/')
+@app.get('/api/getPixelImage/{file_name}')
+async def serve_image_get(request: Request, response: Response, settings: Settings = Depends(), file_name: str = '', start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = '', response_format: str = 'json'):
+    # same as the POST endpoint with the settings as query parameters, so browsers can revalidate it with If-None-Match
+    return await serve_image(request, response, settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method, response_format)
 
-            'max_samples': max_samples,
 
-            'summary_data': summary_data_std,
-            'ordering_idc': sliced_ordering,
+@app.get('/api/getPixelMeta')
+@app.get('/api/getPixelMeta/')
+@app.get('/api/getPixelMeta/{file_name}')
+async def serve_meta(request: Request, settings: Settings = Depends(), file_name: str = '', start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
+    # the meta data of getPixelImage in a DVTS container (see binary.py)
 
-            'data_lengths': proportion_for_image,
-            'data_lengths_scaled': proportion_for_image_scaled,
+    if not finished_pre_loading:
+        raise HTTPException(status_code=503, detail='Data not loaded yet')
 
-            'interestingness': selected_interestingness_idc,
-        }
-   }
+    if file_name == '':
+        file_name = m.get_default_file_name()
 
-    return ret_tmp
+    etag = f'"{c.make_key(file_name, m.get_file_fingerprint(file_name), start, end, stage, ordering_base, ordering_method, attribution_method, settings.dict(), "meta")}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    packed = render_cache.get(etag)
+    if packed is None:
+        check_file(file_name)
+        packed = render_cache.put(etag, await run_rendering(request, r.render_pixel_meta_binary, settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method))
+
+    return Response(content=packed, media_type=b.media_type, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+
+@app.get('/api/getPixelData')
+@app.get('/api/getPixelData/')
+@app.get('/api/getPixelData/{file_name}')
+async def serve_data(request: Request, settings: Settings = Depends(), file_name: str = '', start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = '', bits: int = 8):
+    # the shown blocks of getPixelImage in ordering order, normalized and quantized to
+    # uint8 (bits=8) or uint16 (bits=16) in a DVTS container, for coloring on the client:
+    # <block> levels, <block>.min and <block>.max the row range before normalization,
+    # <block>.nan the flat indices of NaN values (bad color) if the block has any
+
+    if not finished_pre_loading:
+        raise HTTPException(status_code=503, detail='Data not loaded yet')
+
+    if bits not in [8, 16]:
+        raise HTTPException(status_code=400, detail=f'Unsupported bits {bits}, use 8 or 16')
+
+    if file_name == '':
+        file_name = m.get_default_file_name()
+
+    etag = f'"{c.make_key(file_name, m.get_file_fingerprint(file_name), start, end, stage, ordering_base, ordering_method, attribution_method, settings.dict(), "data", bits)}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    packed = render_cache.get(etag)
+    if packed is None:
+        check_file(file_name)
+        packed = render_cache.put(etag, await run_rendering(request, r.render_pixel_data, settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method, bits))
+
+    return Response(content=packed, media_type=b.media_type, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+
+@app.get('/api/getSummaryData')
+@app.get('/api/getSummaryData/')
+@app.get('/api/getSummaryData/{file_name}')
+async def get_summary_data(request: Request, file_name: str = '', stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
+    if file_name == '':
+        file_name = m.get_default_file_name()
+
+    check_file(file_name)
+    return await run_rendering(request, r.render_summary_data, file_name, stage, ordering_base, ordering_method, attribution_method)
+
+
+@app.get('/api/getTileInfo/{file_name}')
+async def get_tile_info(request: Request, settings: Settings = Depends(), file_name: str = '', stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
+    check_file(file_name)
+    return await run_rendering(request, t.render_tile_info, file_name, settings, stage, ordering_base, ordering_method, attribution_method)
+
+
+@app.get('/api/getPixelTile/{file_name}/{z}/{x}/{y}')
+async def serve_tile(request: Request, z: int, x: int, y: int, settings: Settings = Depends(), file_name: str = '', stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
+    check_file(file_name)
+    view = await run_rendering(request, t.resolve_tile_view, file_name, stage, ordering_base, ordering_method, attribution_method)
+    view_key = t.tile_view_key(*view, settings)
+
+    etag = f'"{c.make_key(file_name, m.get_file_fingerprint(file_name), view_key, z, x, y)}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    # precomputed tiles first, then render the tile on demand
+    tile = render_cache.get(etag)
+    if tile is None:
+        tile = t.load_tile(file_name, view_key, z, x, y)
+    if tile is None:
+        tile = await run_rendering(request, t.render_view_tile, file_name, settings, *view, z, x, y)
+    if tile is None:
+        raise HTTPException(status_code=404, detail=f'Tile {z}/{x}/{y} not found')
+    render_cache.put(etag, tile)
+
+    return Response(content=tile, media_type='image/png', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
 
 
 @app.post('/api/nearestneighbor/{file_name}/{idx}')
-async def serve_nearestneighbors(file_name: str, idx: int, settings: Settings, start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
-    pass
+async def serve_nearestneighbors(request: Request, file_name: str, idx: int, settings: Settings, start: int = 0, end: int = -1, stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = '', k: int = 10, representation: str = 'raw_data', metric: str = 'euclidean'):
+    # the k nearest samples of sample idx in one representation (raw_data, activations
+    # or the attributions of attribution_method), ordering_idc is idx followed by them
+
+    if representation not in r.neighbor_representations:
+        raise HTTPException(status_code=400, detail=f'Unknown representation {representation}, use one of {", ".join(r.neighbor_representations)}')
+    if metric not in n.metrics:
+        raise HTTPException(status_code=400, detail=f'Unknown metric {metric}, use one of {", ".join(n.metrics)}')
+    if k < 1:
+        raise HTTPException(status_code=400, detail='k has to be at least 1')
+
+    check_file(file_name)
+    try:
+        return await run_rendering(request, r.render_nearest_neighbors, file_name, idx, k, representation, metric, stage, ordering_base, ordering_method, attribution_method)
+    except IndexError as error:
+        raise HTTPException(status_code=404, detail=str(error))
 
 
 @app.get('/api/getAvailableColors')
@@ -264,17 +309,25 @@ async def get_available_colors():
     return JSONResponse(content=i.get_available_colormaps())
 
 
+@app.get('/api/getCacheStats')
+async def get_cache_stats():
+    # dataset and summary caches of this process, render workers keep their own
+    return JSONResponse(content={'datasets': r.dataset_cache.stats(), 'renders': render_cache.stats(), 'summaries': r.summary_cache.stats(), 'envelopes': r.envelope_cache.stats(), 'neighbors': r.neighbor_cache.stats()})
+
+
 @app.get('/api/getAvailableDatasets')
 async def get_available_datasets():
     default_dataset = m.get_default_file_name()
-    return_content = {'datasets': list(cache.keys()), 'default': default_dataset}
+    return_content = {'datasets': data_files, 'default': default_dataset}
     return JSONResponse(content=return_content)
 
 
 @app.post('/api/getTimeSeriesForIdc')
 @app.post('/api/getTimeSeriesForIdc/')
 @app.post('/api/getTimeSeriesForIdc/{file_name}')
-async def get_time_series_for_idc(body: dict, file_name: str = '', stage: str = ''):
+async def get_time_series_for_idc(request: Request, body: dict, file_name: str = '', stage: str = '', ordering_base: str = '', ordering_method: str = '', attribution_method: str = ''):
+    # the ordering parameters name the view the idc were brushed in, contiguous
+    # ranges of its ordering take their quantiles from a precomputed envelope
 
     if file_name == '':
         file_name = m.get_default_file_name()
@@ -287,26 +340,15 @@ async def get_time_series_for_idc(body: dict, file_name: str = '', stage: str =
 
     selected_idc = np.array(body['idc']).astype(int)
 
-    loaded_data = load_file(file_name)
-
-    orderings = loaded_data.orderings
-    data = loaded_data.data
-
-    if stage == '':
-        stage, _ = data.get_default()
-
-    collected_data = m.parse_model_to_dict(data.get(stage))
-    selected_data = collected_data['raw_data'][selected_idc]
-
-    start = body['start']
-    end = body['end']
-    if start < 1 and isinstance(start, float):
-        start = start * selected_data.shape[1]
-    if end < 1 and isinstance(end, float):
-        end = end * selected_data.shape[1]
+    # lines, density or auto (density for selections above density_threshold)
+    mode = body.get('mode', 'auto')
+    if mode not in r.time_series_modes:
+        raise HTTPException(status_code=400, detail=f'Unknown mode {mode}, use one of {", ".join(r.time_series_modes)}')
+    threshold = int(body.get('density_threshold', r.density_threshold))
 
-    image = i.idc_to_image(selected_data, start, end)
-    image_base64 = base64.b64encode(image.read())
+    check_file(file_name)
+    image = await run_rendering(request, r.render_time_series, file_name, stage, selected_idc, body['start'], body['end'], mode, threshold, ordering_base, ordering_method, attribution_method)
+    image_base64 = base64.b64encode(image)
     
     ret_tmp = {
        'image': image_base64,
@@ -0,0 +1,85 @@
+import json
+import struct
+
+import numpy as np
+
+
+# Compact container for typed arrays plus a small JSON header, so large index
+# and summary arrays do not go through base64 and the JSON encoder.
+#
+#   magic        4 bytes  b'DVTS'
+#   version      uint32   little endian
+#   header size  uint32   little endian
+#   header       JSON (utf-8), padded with spaces to the alignment
+#   arrays       raw little endian data, each starting at an aligned offset
+#
+# The header holds the metadata and a list of arrays like
+# {"name": "ordering_idc", "dtype": "<i4", "shape": [3601], "offset": 64, "nbytes": 14404},
+# offsets count from the start of the container. The alignment of 8 bytes lets
+# a browser create typed array views (Int32Array, Float32Array, ...) on the body.
+
+magic = b'DVTS'
+version = 1
+alignment = 8
+
+media_type = 'application/octet-stream'
+
+prefix = struct.Struct('<4sII')
+
+
+def align(offset):
+    return -(-offset // alignment) * alignment
+
+
+def little_endian(arr):
+    arr = np.ascontiguousarray(arr)
+    if arr.dtype.byteorder == '>':
+        arr = arr.astype(arr.dtype.newbyteorder('<'))
+    return arr
+
+
+def pack(meta=None, arrays=None):
+    # arrays: name -> ndarray, the dtype is kept so convert before packing
+    arrays = {k: little_endian(v) for k, v in (arrays or {}).items()}
+
+    # the header size depends on the offsets and the offsets on the header size,
+    # so place the arrays relative to the header first and shift them afterwards
+    entries = []
+    offset = 0
+    for k, v in arrays.items():
+        offset = align(offset)
+        entries.append({'name': k, 'dtype': v.dtype.str, 'shape': list(v.shape), 'offset': offset, 'nbytes': v.nbytes})
+        offset += v.nbytes
+
+    header_size = 0
+    while True:
+        data_start = align(prefix.size + header_size)
+        header = json.dumps({'meta': meta or {}, 'arrays': [{**e, 'offset': e['offset'] + data_start} for e in entries]}).encode('utf-8')
+        if align(prefix.size + len(header)) == data_start:
+            break
+        header_size = len(header)
+    header = header.ljust(data_start - prefix.size, b' ')
+
+    buffer = bytearray(data_start + offset)
+    buffer[:data_start] = prefix.pack(magic, version, len(header)) + header
+    for e, v in zip(entries, arrays.values()):
+        start = e['offset'] + data_start
+        buffer[start:start + v.nbytes] = v.tobytes()
+
+    return bytes(buffer)
+
+
+def unpack(buffer):
+    buffer = memoryview(buffer)
+    magic_, version_, header_size = prefix.unpack_from(buffer)
+    if magic_ != magic:
+        raise ValueError('Not a DVTS container')
+    if version_ > version:
+        raise ValueError(f'Unsupported DVTS container version {version_}')
+
+    header = json.loads(bytes(buffer[prefix.size:prefix.size + header_size]))
+    arrays = {}
+    for e in header['arrays']:
+        arrays[e['name']] = np.frombuffer(buffer, dtype=e['dtype'], count=int(np.prod(e['shape'])), offset=e['offset']).reshape(e['shape'])
+
+    return header['meta'], arrays
@@ -0,0 +1,186 @@
+import os
+import json
+import mmap
+import pickle
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+from pydantic import BaseModel
+
+
+# memory-mapped arrays are pages of their file that the kernel can drop again,
+# they are charged with this instead of their size
+mapped_array_bytes = 4096
+
+
+def is_mapped(array):
+    # memmaps and views of them, their bases end in the mmap of the file
+    while isinstance(array, np.ndarray):
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
+def size_of(obj):
+    if isinstance(obj, np.ndarray):
+        return min(obj.nbytes, mapped_array_bytes) if is_mapped(obj) else obj.nbytes
+    if isinstance(obj, BaseModel):
+        return size_of(obj.__dict__)
+    if isinstance(obj, dict):
+        return sum(size_of(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(size_of(v) for v in obj)
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    if isinstance(obj, (int, float)):
+        return 8
+    return 0
+
+
+def make_key(*parts):
+    key = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+
+    def __init__(self, name, max_bytes=0, size_fn=size_of, spill_path=None):
+        # max_bytes <= 0 disables the budget, evicted entries are pickled
+        # to spill_path (if set) and loaded again on a later miss
+        self.name = name
+        self.max_bytes = max_bytes
+        self.size_fn = size_fn
+
+        self.spill_path = spill_path
+        if spill_path is not None:
+            os.makedirs(spill_path, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def keys(self):
+        return list(self.entries.keys())
+
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        value = self.load_spilled(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.spill_hits += 1
+        return self.put(key, value)
+
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        with self.lock:
+            if key in self.entries:
+                self.current_bytes -= self.sizes[key]
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.sizes[key] = size
+            self.current_bytes += size
+            evicted = self.evict()
+        # pickling to disk would block every other get and put of the cache
+        for evicted_key, evicted_value in evicted:
+            self.spill(evicted_key, evicted_value)
+        return value
+
+
+    def pop(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.current_bytes -= self.sizes.pop(key)
+            return self.entries.pop(key)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.current_bytes = 0
+
+
+    def evict(self):
+        # called with the lock held, returns the evicted entries for spill.
+        # The newest entry is always kept, even if it alone exceeds the budget
+        evicted = []
+        while self.max_bytes > 0 and self.current_bytes > self.max_bytes and len(self.entries) > 1:
+            key, value = self.entries.popitem(last=False)
+            self.current_bytes -= self.sizes.pop(key)
+            self.evictions += 1
+            evicted.append((key, value))
+            print(f'Evicted {key} from the {self.name} cache')
+        return evicted
+
+
+    def spill_file(self, key):
+        return os.path.join(self.spill_path, f'{make_key(key)}.pkl')
+
+
+    def spill(self, key, value):
+        if self.spill_path is None:
+            return
+        # a temporary file per write, several workers may share the spill directory
+        fd, tmp_path = tempfile.mkstemp(dir=self.spill_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.spill_file(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+    def load_spilled(self, key):
+        if self.spill_path is None:
+            return None
+        try:
+            with open(self.spill_file(key), 'rb') as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spill_hits': self.spill_hits,
+                'sizes': {str(k): v for k, v in self.sizes.items()},
+            }
@@ -0,0 +1,152 @@
+import numpy as np
+
+
+# Brushes in the pixel view select contiguous ranges of an ordering. An envelope
+# is a segment tree over the positions of one ordering, every node holds for its
+# block of samples a histogram per time step over fixed value bins and the exact
+# min and max per time step. A range is merged from O(log N) nodes, only the at
+# most 2 * leaf_size samples at its ragged ends are read from the data.
+#
+#   levels[0]  blocks of leaf_size samples
+#   levels[k]  blocks of leaf_size * 2^k samples, the sum of two blocks below
+
+leaf_size = 1024
+value_bins = 128
+
+# smaller ranges are cheaper to compute from the rows themselves
+min_range = 2 * leaf_size
+
+
+def bin_edges(data, bins=value_bins):
+    min_, max_ = float(np.min(data)), float(np.max(data))
+    if min_ == max_:
+        min_, max_ = min_ - 0.5, max_ + 0.5
+    return np.linspace(min_, max_, bins + 1)
+
+
+def bin_rows(rows, edges):
+    # value bin of every value, the max falls into the last bin
+    bins = len(edges) - 1
+    idx = np.floor((rows - edges[0]) / (edges[-1] - edges[0]) * bins).astype(np.intp)
+    return np.clip(idx, 0, bins - 1, out=idx)
+
+
+def rows_histogram(rows, edges):
+    # bins x time steps
+    bins, length = len(edges) - 1, rows.shape[1]
+    idx = bin_rows(rows, edges) * length + np.arange(length)
+    return np.bincount(idx.ravel(), minlength=bins * length).reshape(bins, length)
+
+
+def build_envelope(data, ordering, bins=value_bins, leaf_size=leaf_size):
+    ordering = np.asarray(ordering)
+    edges = bin_edges(data, bins)
+    length = data.shape[1]
+    blocks = len(ordering) // leaf_size
+
+    histogram = np.zeros((blocks, bins, length), dtype=np.int32)
+    min_ = np.zeros((blocks, length), dtype=data.dtype)
+    max_ = np.zeros((blocks, length), dtype=data.dtype)
+    for block in range(blocks):
+        rows = data[np.sort(ordering[block * leaf_size:(block + 1) * leaf_size])]
+        histogram[block] = rows_histogram(rows, edges)
+        min_[block] = np.min(rows, axis=0)
+        max_[block] = np.max(rows, axis=0)
+
+    levels = [{'histogram': histogram, 'min': min_, 'max': max_}]
+    while len(levels[-1]['histogram']) > 1:
+        below = levels[-1]
+        pairs = len(below['histogram']) // 2
+        levels.append({
+            'histogram': below['histogram'][0:2 * pairs:2] + below['histogram'][1:2 * pairs:2],
+            'min': np.minimum(below['min'][0:2 * pairs:2], below['min'][1:2 * pairs:2]),
+            'max': np.maximum(below['max'][0:2 * pairs:2], below['max'][1:2 * pairs:2]),
+        })
+
+    return {'edges': edges, 'leaf_size': leaf_size, 'length': len(ordering), 'levels': levels}
+
+
+def envelope_nodes(first, last):
+    # (level, node) covering the leaf blocks [first, last) like a bottom up segment tree
+    nodes = []
+    level = 0
+    while first < last:
+        if first % 2 == 1:
+            nodes.append((level, first))
+            first += 1
+        if last % 2 == 1:
+            last -= 1
+            nodes.append((level, last))
+        first //= 2
+        last //= 2
+        level += 1
+    return nodes
+
+
+def query_envelope(envelope, data, ordering, start, end):
+    # histogram (bins x time steps), min and max of the samples at positions [start, end) of the ordering
+    leaf_size = envelope['leaf_size']
+    edges = envelope['edges']
+    levels = envelope['levels']
+    blocks = len(levels[0]['histogram'])
+
+    first = min(-(-start // leaf_size), blocks)
+    last = max(min(end // leaf_size, blocks), first)
+
+    # the samples outside of whole blocks
+    positions = np.concatenate([np.arange(start, min(first * leaf_size, end)), np.arange(max(last * leaf_size, start), end)])
+    if first == last:
+        positions = np.arange(start, end)
+
+    length = data.shape[1]
+    histogram = np.zeros((len(edges) - 1, length), dtype=np.int64)
+    min_ = np.full(length, np.inf)
+    max_ = np.full(length, -np.inf)
+
+    if len(positions) > 0:
+        rows = data[np.sort(np.asarray(ordering)[positions])]
+        histogram += rows_histogram(rows, edges)
+        min_ = np.minimum(min_, np.min(rows, axis=0))
+        max_ = np.maximum(max_, np.max(rows, axis=0))
+
+    if first < last:
+        for level, node in envelope_nodes(first, last):
+            histogram += levels[level]['histogram'][node]
+            min_ = np.minimum(min_, levels[level]['min'][node])
+            max_ = np.maximum(max_, levels[level]['max'][node])
+
+    return histogram, min_, max_
+
+
+def envelope_quantiles(histogram, edges, min_, max_, quantiles):
+    # quantiles per time step interpolated linearly inside their value bin,
+    # 0 and 1 are the exact min and max
+    cumulative = np.cumsum(histogram, axis=0)
+    total = cumulative[-1]
+
+    values = []
+    for q in quantiles:
+        rank = q * total
+        bins = np.minimum(np.argmax(cumulative >= np.maximum(rank, 1e-9), axis=0), len(histogram) - 1)
+        below = np.where(bins > 0, cumulative[bins - 1, np.arange(len(bins))], 0)
+        inside = histogram[bins, np.arange(len(bins))]
+        frac = np.divide(rank - below, inside, out=np.zeros(len(bins)), where=inside > 0)
+        value = edges[bins] + frac * (edges[bins + 1] - edges[bins])
+        values.append(np.clip(value, min_, max_))
+
+    values = np.array(values)
+    quantiles = np.asarray(quantiles)
+    values[quantiles == 0] = min_
+    values[quantiles == 1] = max_
+    return values
+
+
+def contiguous_range(ordering, inverse, idc):
+    # [start, end) if the selected samples are exactly a contiguous range of the ordering, else None
+    if len(idc) < 1:
+        return None
+    positions = inverse[idc]
+    start, end = int(np.min(positions)), int(np.max(positions)) + 1
+    if end - start != len(idc) or len(np.unique(positions)) != len(idc):
+        return None
+    return start, end
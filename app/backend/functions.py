@@ -2,9 +2,22 @@ import numpy as np
 
 from dist_functions import cosine
 
-
-def k_nearest_neighbor_ordering(idx, data):
-    pass
+from neighbors import prepare_vectors, squared_distances, search
+
+
+def k_nearest_neighbor_ordering(idx, data, k=None, index=None, metric='euclidean'):
+    # sample idx followed by its k nearest neighbors (all samples if k is None)
+    # by increasing distance, from a prebuilt index if there is one
+    if index is not None and k is not None:
+        neighbors, _ = search(index, np.asarray(data[idx:idx + 1]), k + 1)
+        neighbors = [x for x in neighbors[0] if x != idx and x >= 0][:k]
+        return np.array([idx, *neighbors], dtype=int)
+
+    vectors = prepare_vectors(data, metric)
+    distances = squared_distances(vectors[idx:idx + 1], vectors)[0]
+    distances[idx] = -1
+    ordering = np.argsort(distances, kind='stable')
+    return ordering if k is None else ordering[:k + 1]
 
 
 
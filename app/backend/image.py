@@ -5,7 +5,6 @@ import numpy as np
 from PIL import Image
 
 import matplotlib as mpl
-import matplotlib.pyplot as plt
 
 from sklearn.preprocessing import KBinsDiscretizer
 from sklearn.preprocessing import PowerTransformer
@@ -19,22 +18,39 @@ def minmax_norm(data):
     return (data - min_) / (max_ - min_)
 
 
-def minmax_normalize(data, axis=1):
+def float_buffer(data, out=None):
+    if out is not None:
+        return out
+    dtype = data.dtype if data.dtype.kind == 'f' else np.float64
+    return np.empty(data.shape, dtype=dtype)
+
+
+def minmax_normalize(data, axis=1, out=None):
     if axis == -1:
         return minmax_norm(data)
-    else:
-        return np.apply_along_axis(minmax_norm, axis, data)
 
+    min_ = np.min(data, axis=axis, keepdims=True)
+    range_ = np.max(data, axis=axis, keepdims=True) - min_
+    # constant rows are all zero after the subtraction, keep them at 0
+    range_[range_ == 0] = 1
+
+    # out may be data itself to normalize in place
+    out = float_buffer(data, out)
+    np.subtract(data, min_, out=out)
+    np.divide(out, range_, out=out)
+    return out
 
-def sqrt_normalize(data, axis=1):
+
+def sqrt_normalize(data, axis=1, out=None):
     def sqrt_norm(data):
         data_sqrt = np.sqrt(data)
         return minmax_norm(data_sqrt)
 
     if axis == -1:
         return sqrt_norm(data)
-    else:
-        return np.apply_along_axis(sqrt_norm, axis, data)
+
+    out = np.sqrt(data, out=float_buffer(data, out))
+    return minmax_normalize(out, axis, out=out)
 
 
 def robust_normalize(data, axis=1):
@@ -49,14 +65,18 @@ def robust_normalize(data, axis=1):
         return np.apply_along_axis(robust_norm, axis, data)
 
 
-def normalize(data, strategy='MinMax'):
+def normalize(data, strategy='MinMax', out=None):
     if strategy == 'MinMax':
-        return minmax_normalize(data)
+        return minmax_normalize(data, out=out)
     elif strategy == 'Sqrt':
-        return sqrt_normalize(data)
+        return sqrt_normalize(data, out=out)
     elif strategy == 'Robust':
-        return robust_normalize(data)
-    return minmax_normalize(data)
+        data = robust_normalize(data)
+        if out is not None:
+            out[...] = data
+            return out
+        return data
+    return minmax_normalize(data, out=out)
 
 
 def discretizer(data):
@@ -68,7 +88,7 @@ def discretizer(data):
     return np.apply_along_axis(disc, 1, data).reshape(*shape)
 
 
-def only_quantiles(data, axis=1, quant_range=0.1):
+def only_quantiles(data, axis=1, quant_range=0.1, out=None):
     def quant(data):
         lower_bound = np.quantile(data, quant_range)
         upper_bound = np.quantile(data, 1 - quant_range)
@@ -82,8 +102,18 @@ def only_quantiles(data, axis=1, quant_range=0.1):
 
     if axis == -1:
         return quant(data)
-    else:
-        return np.apply_along_axis(quant, 1, data)
+
+    lower_bound, upper_bound = np.quantile(data, [quant_range, 1 - quant_range], axis=axis, keepdims=True)
+    fill = (np.max(data, axis=axis, keepdims=True) - np.min(data, axis=axis, keepdims=True)) / 2
+    mask = (data > lower_bound) & (upper_bound > data)
+
+    if out is None:
+        out = np.copy(data)
+    elif out is not data:
+        np.copyto(out, data)
+    np.copyto(out, np.broadcast_to(fill, out.shape), where=mask, casting='unsafe')
+
+    return out
 
 
 mpl_colormaps = {
@@ -95,101 +125,442 @@ mpl_colormaps = {
     'interpolateViridis': mpl.colormaps['viridis']
 }
 
-def data_to_color(data, colormap=''):
-    cmap = mpl.colormaps['binary']
-    if colormap in mpl_colormaps:
-        cmap = mpl_colormaps[colormap]
-    return cmap(data)
+default_colormap = mpl.colormaps['binary']
+
+
+def colormap_lut(cmap):
+    # rows 0..N-1 are the colormap entries, followed by the under, over and
+    # bad colors in the same order matplotlib uses internally
+    lut = np.vstack([cmap(np.arange(cmap.N)), cmap(np.array([-1.0, 2.0, np.nan]))])
+    return np.uint8(lut * 255)
+
+
+colormap_luts = {k: colormap_lut(v) for k, v in mpl_colormaps.items()}
+default_colormap_lut = colormap_lut(default_colormap)
+
+
+def color_indices(data, n):
+    # same quantization matplotlib applies to floats in Colormap.__call__
+    x = np.multiply(data, n, dtype=float)
+    under = x < 0
+    bad = np.isnan(x)
+
+    x[x == n] = n - 1
+    np.clip(x, 0, n, out=x)
+    x[bad] = 0
+
+    idx = x.astype(np.uint16)
+    idx[idx > n - 1] = n + 1
+    idx[under] = n
+    idx[bad] = n + 2
+    return idx
+
+
+def data_to_color(data, colormap='', out=None):
+    lut = colormap_luts.get(colormap, default_colormap_lut)
+    idx = color_indices(data, len(lut) - 3)
+    if out is None:
+        out = np.empty((*idx.shape, 4), dtype=np.uint8)
+    # uint8 RGBA, identical to np.uint8(cmap(data) * 255)
+    return np.take(lut, idx, axis=0, out=out)
+
+
+def quantize(data, bits=8):
+    # normalized [0, 1] values to integer levels, with 8 bits a level is the
+    # index into a 256 entry colormap, so the client colors like data_to_color.
+    # NaN has no level and becomes 0 here, data_to_color uses the bad color for
+    # it, use nan_positions to mark these values
+    levels = 2 ** bits
+    dtype = np.uint8 if bits <= 8 else np.uint16
+
+    x = np.multiply(data, levels, dtype=float)
+    x[np.isnan(x)] = 0
+    np.clip(x, 0, levels - 1, out=x)
+    return x.astype(dtype)
+
+
+def nan_positions(data):
+    # flat indices of the NaN values, the client colors them with the bad color
+    return np.flatnonzero(np.isnan(data)).astype(np.int32)
 
 
 def get_available_colormaps():
     return list(mpl_colormaps.keys())
 
 
-def data_to_image(data, resolution=None, direction='horizontal', divider_length=1):
+def nearest_indices(source_length, target_length):
+    # source index for every target pixel, the same positions PIL samples
+    # for Image.NEAREST (pixel centers, accumulated step by step)
+    scale = source_length / target_length
+    steps = np.full(target_length, scale)
+    steps[0] = scale * 0.5
+    idx = np.add.accumulate(steps).astype(np.intp)
+    return np.minimum(idx, source_length - 1)
+
+
+def block_layout(widths, divider_length=1):
+    # [start, end, block index] along the concatenated columns, None for dividers
+    layout = []
+    offset = 0
+    for b, width in enumerate(widths):
+        if b > 0 and divider_length > 0:
+            layout.append([offset, offset + divider_length, None])
+            offset += divider_length
+        layout.append([offset, offset + width, b])
+        offset += width
+    return layout, offset
+
+
+def compose_blocks(blocks, layout, row_idx, col_idx, direction='horizontal', out=None):
+    # write the nearest neighbour samples of every block straight into one RGBA canvas,
+    # row_idx picks the samples and col_idx the concatenated columns (non-decreasing)
+    if direction == 'horizontal':
+        shape = (len(col_idx), len(row_idx), 4)
+    else:
+        shape = (len(row_idx), len(col_idx), 4)
+    if out is None:
+        out = np.empty(shape, dtype=np.uint8)
 
-    # how many pixel per value
-    resolution_width, resolution_height = [0, 0]
-    if resolution is not None:
-        resolution_width, resolution_height = resolution
+    for start, end, b in layout:
+        p0, p1 = np.searchsorted(col_idx, [start, end])
+        if p1 <= p0:
+            continue
 
-    # loop through each item in the data array
-    data_for_image = []
-    for d in data:
-        # if the data item is not already a 2D array, reshape it to a column vector
-        if len(d.shape) < 2:
-            d = d.reshape(-1, 1)
+        if b is None:
+            part = 255
+        else:
+            src_cols = col_idx[p0:p1] - start
+            if direction == 'horizontal':
+                part = blocks[b][row_idx[np.newaxis, :], src_cols[:, np.newaxis]]
+            else:
+                part = blocks[b][row_idx[:, np.newaxis], src_cols[np.newaxis, :]]
 
-        # scale the values in the data item to the range [0, 255]
-        # add the scaled data item to the list of data for the image
-        d = d * 255
-        data_for_image.append(d)
+        if direction == 'horizontal':
+            out[p0:p1, :] = part
+        else:
+            out[:, p0:p1] = part
 
-        # create a divider image to separate the data items
-        div = np.ones((len(d), divider_length, 4)) * 255
-        data_for_image.append(div)
+    return out
 
-    # remove the last divider image from the list
-    data_for_image = data_for_image[:-divider_length or None]
 
-    # concatenate all of the data items and divider images into a single image array
-    data_for_image = np.hstack(data_for_image)
+def image_to_buffer(data, format='PNG', **params):
+    img = Image.fromarray(data)
+
+    # save the image to an in-memory buffer
+    buffer = io.BytesIO()
+    img.save(buffer, format=format, **params)
+    buffer.seek(0)
+
+    return buffer
+
 
-    # transpose if direction is changed
+def data_to_pixels(data, resolution=None, direction='horizontal', divider_length=1):
+
+    # how many pixel per value
+    resolution_width, resolution_height = [0, 0]
+    if resolution is not None:
+        resolution_width, resolution_height = resolution
+
+    blocks = []
+    for d in data:
+        # colors from data_to_color are already uint8, scale float colors to [0, 255]
+        if d.dtype != np.uint8:
+            d = np.uint8(d * 255)
+        # a single value per sample becomes a one column block
+        if len(d.shape) < 3:
+            d = d.reshape(len(d), 1, 4)
+        blocks.append(d)
+
+    samples = len(blocks[0])
+    layout, columns = block_layout([d.shape[1] for d in blocks], divider_length)
+
+    data_resolution_height, data_resolution_width = samples, columns
     if direction == 'horizontal':
-        data_for_image = np.transpose(data_for_image, (1, 0, 2))
+        data_resolution_height, data_resolution_width = columns, samples
 
     # change resolution if data is too large
-    data_resolution_height, data_resolution_width = data_for_image.shape[:2]
     print(data_resolution_width, data_resolution_height, resolution_width, resolution_height)
     if direction == 'horizontal' and data_resolution_width > resolution_width:
         resolution_width = data_resolution_width
     if direction == 'vertical' and data_resolution_height > resolution_height:
         resolution_height = data_resolution_height
+    if resolution_width <= 0:
+        resolution_width = data_resolution_width
+    if resolution_height <= 0:
+        resolution_height = data_resolution_height
 
-    # create an image from the data matrix
-    img = Image.fromarray(np.uint8(data_for_image))
-    img = img.resize((resolution_width, resolution_height), resample=Image.NEAREST)
+    if direction == 'horizontal':
+        row_idx = nearest_indices(samples, resolution_width)
+        col_idx = nearest_indices(columns, resolution_height)
+    else:
+        row_idx = nearest_indices(samples, resolution_height)
+        col_idx = nearest_indices(columns, resolution_width)
 
-    # save the image to an in-memory buffer
-    buffer = io.BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
+    return compose_blocks(blocks, layout, row_idx, col_idx, direction)
 
-    return buffer
 
+def data_to_image(data, resolution=None, direction='horizontal', divider_length=1):
+    return image_to_buffer(data_to_pixels(data, resolution, direction, divider_length))
+
+
+# size of the image the former matplotlib figure had after the tight crop
+plot_width = 610
+plot_height = 450
+# matplotlib's default data margins
+plot_margin = 0.05
+# ~1.5 pt lines at 100 dpi
+line_thickness = 2
+
+plot_background = np.array([1.0, 1.0, 1.0])
+plot_line_color = (np.array([0.5, 0.5, 0.5]), 0.2)
+plot_highlight_color = (np.array([1.0, 0.0, 0.0]), 0.1)
+# quantile, color and alpha in drawing order
+plot_quantiles = [
+    (1.0, np.array([0.0, 0.0, 0.0]), 0.4),
+    (0.9, np.array([0.0, 0.0, 1.0]), 0.4),
+    (0.5, np.array([1.0, 0.647, 0.0]), 1.0),
+    (0.1, np.array([0.0, 0.0, 1.0]), 0.4),
+    (0.0, np.array([0.0, 0.0, 0.0]), 0.4),
+]
+
+
+def plot_limits(lower, upper):
+    if upper == lower:
+        lower, upper = lower - 1, upper + 1
+    margin = (upper - lower) * plot_margin
+    return lower - margin, upper + margin
+
+
+def line_columns(length, width, x_limits):
+    # the pixel column edges in data coordinates, which columns the line spans and
+    # the first vertex of every column that has vertices
+    edges = np.linspace(x_limits[0], x_limits[1], width + 1)
+    valid = (edges[1:] >= 0) & (edges[:-1] <= length - 1)
+
+    vertex_columns = np.clip(np.searchsorted(edges, np.arange(length), side='right') - 1, 0, width - 1)
+    columns, starts = np.unique(vertex_columns, return_index=True)
+
+    return np.clip(edges, 0, length - 1), valid, columns, starts
+
+
+def line_rows(data, x_columns, height, y_limits, thickness=line_thickness):
+    # the first and last pixel row every polyline covers in each column, a column
+    # spans the values at both of its edges and at all vertices inside it
+    edges, _, columns, starts = x_columns
+    length = data.shape[1]
+    if length > 1:
+        left = np.minimum(edges.astype(np.intp), length - 2)
+        frac = (edges - left).astype(data.dtype)
+        values = data[:, left] * (1 - frac) + data[:, left + 1] * frac
+    else:
+        values = np.repeat(data, len(edges), axis=1)
 
-def idc_to_image(data, highlight_start=0, highlight_end=0):
+    lower = np.minimum(values[:, :-1], values[:, 1:])
+    upper = np.maximum(values[:, :-1], values[:, 1:])
+    lower[:, columns] = np.minimum(lower[:, columns], np.minimum.reduceat(data, starts, axis=1))
+    upper[:, columns] = np.maximum(upper[:, columns], np.maximum.reduceat(data, starts, axis=1))
 
-    fig = plt.figure()
-    plt.axis('off')
-    plt.tight_layout()
+    scale = height / (y_limits[1] - y_limits[0])
+    top = np.floor((y_limits[1] - upper) * scale).astype(np.intp) - (thickness - 1) // 2
+    bottom = np.floor((y_limits[1] - lower) * scale).astype(np.intp) + thickness // 2
 
-    quantile_100 = np.quantile(data, 1, axis=0)
-    quantile_90 = np.quantile(data, 0.90, axis=0)
-    quantile_50 = np.quantile(data, 0.5, axis=0)
-    quantile_10 = np.quantile(data, 0.10, axis=0)
-    quantile_0 = np.quantile(data, 0, axis=0)
+    return np.clip(top, 0, height - 1), np.clip(bottom, 0, height - 1)
 
-    max_ = np.max(data)
-    min_ = np.min(data)
 
+def span_density(top, bottom, columns, width, height):
+    # every span adds +1 at its first and -1 after its last row, a cumsum fills them
+    offset = columns * (height + 1)
+    diff = np.bincount((top[:, columns] + offset).ravel(), minlength=width * (height + 1))
+    diff -= np.bincount((bottom[:, columns] + 1 + offset).ravel(), minlength=width * (height + 1))
+    return np.cumsum(diff.reshape(width, height + 1), axis=1)[:, :height].T
+
+
+def line_density(data, width, height, x_limits, y_limits, thickness=line_thickness, chunk_size=1024):
+    # how many polylines pass through each pixel
+    x_columns = line_columns(data.shape[1], width, x_limits)
+    columns = np.nonzero(x_columns[1])[0]
+
+    density = np.zeros((height, width), dtype=np.int64)
+    for chunk in range(0, len(data), chunk_size):
+        top, bottom = line_rows(data[chunk:chunk + chunk_size], x_columns, height, y_limits, thickness)
+        density += span_density(top, bottom, columns, width, height)
+
+    return density
+
+
+def line_masks(data, width, height, x_limits, y_limits, thickness=line_thickness):
+    # the pixels each polyline covers on its own
+    x_columns = line_columns(data.shape[1], width, x_limits)
+    columns = np.nonzero(x_columns[1])[0]
+
+    top, bottom = line_rows(data, x_columns, height, y_limits, thickness)
+    return [span_density(t[None, :], b[None, :], columns, width, height) > 0 for t, b in zip(top, bottom)]
+
+
+def blend(canvas, color, alpha, mask=None):
+    # alpha compositing of one color over the canvas (or only the pixels in mask),
+    # alpha is a scalar or one value per pixel
+    color = np.asarray(color, dtype=canvas.dtype)
+    alpha = np.asarray(alpha, dtype=canvas.dtype)
+    if mask is not None:
+        mask = np.nonzero(mask)
+        if alpha.ndim == 2:
+            alpha = alpha[mask]
+        pixels = canvas[mask]
+        canvas[mask] = pixels + (color - pixels) * alpha.reshape(-1, 1)
+        return canvas
+    if alpha.ndim == 2:
+        alpha = alpha[:, :, None]
+    canvas += (color - canvas) * alpha
+    return canvas
+
+
+def plot_canvas(min_, max_, length, highlight_start, highlight_end, width, height):
+    # white canvas with the highlight band and the data limits of the plot
+    x_lower, x_upper = 0, length - 1
     if highlight_start != highlight_end:
-        plt.fill_between([highlight_start, highlight_end], min_, max_, color='red', alpha=0.1)
+        x_lower, x_upper = min(x_lower, highlight_start, highlight_end), max(x_upper, highlight_start, highlight_end)
+    x_limits = plot_limits(x_lower, x_upper)
+    y_limits = plot_limits(min_, max_)
 
-    for ts in data:
-        plt.plot(ts, color='gray', alpha=0.2)
+    canvas = np.empty((height, width, 3), dtype=np.float32)
+    canvas[:] = plot_background
 
-    plt.plot(quantile_100, color='black', alpha=0.4)
-    plt.plot(quantile_90, color='blue', alpha=0.4)
-    plt.plot(quantile_50, color='orange')
-    plt.plot(quantile_10, color='blue', alpha=0.4)
-    plt.plot(quantile_0, color='black', alpha=0.4)
+    if highlight_start != highlight_end:
+        x_scale = width / (x_limits[1] - x_limits[0])
+        y_scale = height / (y_limits[1] - y_limits[0])
+        left, right = sorted([(highlight_start - x_limits[0]) * x_scale, (highlight_end - x_limits[0]) * x_scale])
+        top, bottom = (y_limits[1] - max_) * y_scale, (y_limits[1] - min_) * y_scale
+        color, alpha = plot_highlight_color
+        blend(canvas[int(top):int(np.ceil(bottom)), int(left):int(np.ceil(right))], color, alpha)
+
+    return canvas, x_limits, y_limits
 
-    # Save the Matplotlib figure to an in-memory file-like object
-    buffer = io.BytesIO()
-    plt.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0)
-    buffer.seek(0)
 
-    return buffer
-    
+def draw_quantiles(canvas, quantiles, x_limits, y_limits):
+    height, width, _ = canvas.shape
+    for covered, (_, color, alpha) in zip(line_masks(quantiles, width, height, x_limits, y_limits), plot_quantiles):
+        blend(canvas, color, alpha, covered)
+    return canvas
+
+
+def canvas_to_buffer(canvas):
+    # the plot compresses well, a fast compression level is enough
+    return image_to_buffer(np.uint8(np.round(canvas * 255)), compress_level=1)
+
+
+def idc_to_image(data, highlight_start=0, highlight_end=0, width=plot_width, height=plot_height, quantiles=None):
+    # the selected series in gray with their quantiles drawn directly into an array,
+    # the same plot matplotlib drew before without a figure per request,
+    # quantiles (in plot_quantiles order) can come precomputed from an envelope
+    data = np.asarray(data, dtype=np.float32)
+    canvas, x_limits, y_limits = plot_canvas(np.min(data), np.max(data), data.shape[1], highlight_start, highlight_end, width, height)
+
+    # n overlapping lines with alpha a cover a pixel with 1 - (1 - a)^n
+    color, alpha = plot_line_color
+    density = line_density(data, width, height, x_limits, y_limits)
+    coverage = 1 - (1 - alpha) ** np.arange(density.max() + 1, dtype=np.float32)
+    blend(canvas, color, coverage[density], density > 0)
+
+    if quantiles is None:
+        quantiles = np.quantile(data, [q for q, _, _ in plot_quantiles], axis=0)
+    draw_quantiles(canvas, quantiles, x_limits, y_limits)
+
+    return canvas_to_buffer(canvas)
+
+
+def value_histogram(data, height, y_limits, chunk_size=4096):
+    # how many series have a value in each of the height value bins (top row
+    # first) at every time step, one bincount per chunk of series
+    length = data.shape[1]
+    scale = height / (y_limits[1] - y_limits[0])
+    time_idx = np.arange(length)
+
+    histogram = np.zeros(height * length, dtype=np.int64)
+    for chunk in range(0, len(data), chunk_size):
+        rows = np.floor((y_limits[1] - data[chunk:chunk + chunk_size]) * scale).astype(np.intp)
+        np.clip(rows, 0, height - 1, out=rows)
+        histogram += np.bincount((rows * length + time_idx).ravel(), minlength=len(histogram))
+
+    return histogram.reshape(height, length)
+
+
+def histogram_quantiles(histogram, quantiles, y_limits):
+    # quantiles per time step to the resolution of the value bins, the value of
+    # a bin is its center
+    height = len(histogram)
+    from_bottom = np.cumsum(histogram[::-1], axis=0)
+    total = from_bottom[-1]
+
+    bin_size = (y_limits[1] - y_limits[0]) / height
+    values = []
+    for q in quantiles:
+        # first bin from the bottom that reaches the quantile, at least one sample for the minimum
+        rank = np.maximum(np.ceil(q * total), 1)
+        bins = np.argmax(from_bottom >= rank, axis=0)
+        values.append(y_limits[0] + (bins + 0.5) * bin_size)
+    return np.array(values)
+
+
+def histogram_columns(histogram, width, x_limits):
+    # mean count per time step in every pixel column, columns without a time step
+    # show the next one, columns outside the data stay empty
+    length = histogram.shape[1]
+    edges = np.linspace(x_limits[0], x_limits[1], width + 1)
+
+    time_columns = np.clip(np.searchsorted(edges, np.arange(length), side='right') - 1, 0, width - 1)
+    first, last = time_columns[0], time_columns[-1]
+    starts = np.searchsorted(time_columns, np.arange(first, last + 1))
+    steps = np.bincount(time_columns - first, minlength=last - first + 1)
+
+    # reduceat of an empty group gives the time step at its start, the next one
+    columns = np.zeros((len(histogram), width))
+    columns[:, first:last + 1] = np.add.reduceat(histogram, starts, axis=1) / np.maximum(steps, 1)
+    return columns
+
+
+def draw_density(canvas, histogram, x_limits):
+    # the line color with an opacity on a log scale of the count
+    height, width, _ = canvas.shape
+    columns = histogram_columns(histogram, width, x_limits)
+
+    filled = columns > 0
+    if np.any(filled):
+        level = np.log1p(columns) / np.log1p(np.max(columns))
+        blend(canvas, plot_line_color[0], level, filled)
+    return canvas
+
+
+def idc_to_density_image(data, highlight_start=0, highlight_end=0, width=plot_width, height=plot_height):
+    # all selected series binned into a time x value histogram on a log color scale,
+    # the cost does not depend on drawing every series like idc_to_image
+    data = np.asarray(data)
+    canvas, x_limits, y_limits = plot_canvas(np.min(data), np.max(data), data.shape[1], highlight_start, highlight_end, width, height)
+
+    histogram = value_histogram(data, height, y_limits)
+    draw_density(canvas, histogram, x_limits)
+
+    quantiles = histogram_quantiles(histogram, [q for q, _, _ in plot_quantiles], y_limits)
+    draw_quantiles(canvas, quantiles, x_limits, y_limits)
+
+    return canvas_to_buffer(canvas)
+
+
+def rebin_histogram(histogram, edges, height, y_limits):
+    # counts in value bins with the given edges spread over the pixel rows (top
+    # row first) by how much of each bin a row covers
+    row_edges = np.linspace(y_limits[1], y_limits[0], height + 1)
+    overlap = np.minimum(row_edges[:-1, None], edges[None, 1:]) - np.maximum(row_edges[1:, None], edges[None, :-1])
+    weights = np.clip(overlap, 0, None) / np.maximum(np.diff(edges), np.finfo(float).tiny)
+    return weights @ histogram
+
+
+def histogram_to_density_image(histogram, edges, min_, max_, quantiles, highlight_start=0, highlight_end=0, width=plot_width, height=plot_height):
+    # the density plot of idc_to_density_image from an already binned selection
+    # (value bins x time steps with the given bin edges), e.g. merged from an envelope
+    canvas, x_limits, y_limits = plot_canvas(np.min(min_), np.max(max_), histogram.shape[1], highlight_start, highlight_end, width, height)
+
+    draw_density(canvas, rebin_histogram(histogram, edges, height, y_limits), x_limits)
+    draw_quantiles(canvas, quantiles, x_limits, y_limits)
+
+    return canvas_to_buffer(canvas)
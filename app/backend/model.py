@@ -13,6 +13,8 @@ from typing import Optional, Any
 from pydantic import BaseModel, validator
 from pydantic.tools import parse_obj_as
 
+import storage as s
+
 
 files = [
     # ('https://data.time-series-xai.dbvis.de/davots/old/cnn-forda.json', 'cnn-forda.json'),
@@ -34,13 +36,13 @@ def get_default_file_name():
 
 
 def list_to_np(x):
-    return np.array(x)
+    return np.asarray(x)
 
 
 def dict_to_np(x):
     if isinstance(x, dict):
         return {q: dict_to_np(p) for q, p in x.items()}
-    elif isinstance(x, list):
+    elif isinstance(x, (list, np.ndarray)):
         return list_to_np(x)
     else:
         return {}
@@ -94,6 +96,30 @@ class StageData(BaseModel):
         return [x for x in self.attributions.keys() if '_histogram' not in x]
 
 
+    def get_block(self, name, attribution_method=None):
+        # the stored array itself, no copy
+        if name == 'attributions':
+            return self.attributions.get(attribution_method)
+        if name == 'attributions_histogram':
+            return self.attributions.get(f'{attribution_method}_histogram')
+        return getattr(self, name, None)
+
+
+    def get_blocks(self, attribution_method, names=None, idc=None):
+        # views of the requested blocks (all by default) with the attributions of one method,
+        # a slice in idc keeps them views, index arrays gather only the selected rows
+        if names is None:
+            names = self.__fields__.keys()
+
+        blocks = {}
+        for name in names:
+            block = self.get_block(name, attribution_method)
+            if block is None:
+                continue
+            blocks[name] = block if idc is None else block[idc]
+        return blocks
+
+
 class BaseData(BaseModel):
     train: Optional[StageData]
     test: Optional[StageData]
@@ -194,6 +220,13 @@ class OrderingData(BaseModel):
         }
 
 
+    def get_ordering(self, base_data, method, attribution=None):
+        selected_ordering = self.get_orderings(base_data, method, attribution)
+        if selected_ordering is None:
+            return None
+        return selected_ordering['ordering']
+
+
     def get_orderings(self, base_data, method, attribution=None):
         if base_data == 'raw':
             return self.raw[method]
@@ -347,6 +380,34 @@ class Base(BaseModel):
     interestingness: Optional[Interestingness]
 
 
+class Settings(BaseModel):
+    resolution_width: int = 0
+    resolution_height: int = 0
+    
+    layout: str = 'vertical'
+
+    raw_data: bool = True
+    raw_data_histogram: bool = False
+    activations: bool = True
+    activations_histogram: bool = False
+    attributions: bool = True
+    attributions_histogram: bool = False
+    labels_pred: bool = True
+    
+    suggestions: bool = False
+    
+    raw_time_series_colormap: str = 'interpolateRdBu'
+    raw_time_series_histogram_colormap: str = 'interpolateReds'
+
+    activations_colormap: str = 'interpolateReds'
+    activations_histogram_colormap: str = 'interpolateReds'
+
+    attributions_colormap: str = 'interpolateRdBu'
+    attributions_histogram_colormap: str = 'interpolateReds'
+
+    predictions_colormap: str = 'viridis'
+
+
 def convert_keys_to_lower(dictionary):
     if isinstance(dictionary, dict):
         return {key.lower(): convert_keys_to_lower(value) for key, value in dictionary.items()}
@@ -378,19 +439,91 @@ def download_json(url, file_path):
         print(f'Failed to download JSON. Error: {e}')
 
 
+data_path = 'data/'
+
+
 def get_all_available_JSON_files(download=True):
-    data_path = 'data/'
     if download:
         for f in files:
             download_json(f[0], os.path.join(data_path, f[1]))
     return [file for file in os.listdir(data_path) if file.endswith('.json')]
 
 
+def get_all_available_files(download=True):
+    json_files = get_all_available_JSON_files(download)
+    binary_files = [file for file in os.listdir(data_path) if s.is_dataset(os.path.join(data_path, file))]
+    return sorted(set(binary_files) | {file[:-5] for file in json_files})
+
+
+def convert_JSON_file(file_name):
+    json_path = os.path.join(data_path, f'{file_name}.json')
+    binary_path = os.path.join(data_path, file_name)
+
+    start_time = time.time()
+    s.convert_json_file(json_path, binary_path)
+    print(f'{json_path} converted to {binary_path} in {time.time() - start_time:.2f} seconds')
+
+    return binary_path
+
+
+def json_is_newer(binary_path):
+    # a JSON dataset written after its binary conversion
+    json_path = f'{binary_path}.json'
+    manifest_path = os.path.join(binary_path, s.manifest_file)
+    if not os.path.exists(json_path) or not os.path.exists(manifest_path):
+        return False
+    return os.stat(json_path).st_mtime_ns > os.stat(manifest_path).st_mtime_ns
+
+
+def get_file_fingerprint(file_name):
+    # changes whenever the dataset is rewritten, an updated JSON counts before it is converted again
+    binary_path = os.path.join(data_path, file_name)
+    paths = [os.path.join(binary_path, s.manifest_file), f'{binary_path}.json']
+    if json_is_newer(binary_path):
+        paths.reverse()
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            return f'{stat.st_mtime_ns}-{stat.st_size}'
+    return None
+
+
+def prepare_file(file_name):
+    # JSON datasets are converted once, afterwards only the binary dataset is read
+    # until the JSON file is updated
+    binary_path = os.path.join(data_path, file_name)
+
+    if not s.is_dataset(binary_path):
+        if not os.path.exists(f'{binary_path}.json'):
+            return None
+        convert_JSON_file(file_name)
+    elif json_is_newer(binary_path):
+        print(f'{file_name}.json is newer than its binary dataset, converting it again')
+        convert_JSON_file(file_name)
+
+    return binary_path
+
+
+def parse_file(file_name, mmap_mode='r'):
+    binary_path = prepare_file(file_name)
+    if binary_path is None:
+        return {'message': f'{file_name} file not found'}
+
+    # arrays stay memory-mapped, so pages are read on first access and shared
+    # between worker processes through the page cache
+    data = s.load_dataset(binary_path, mmap_mode=mmap_mode)
+    data = convert_keys_to_lower(data)
+    data = parse_obj_as(Base, data)
+    print(f'{file_name} loaded')
+
+    return data
+
+
 def parse_JSON_file(file_path):
     data = None
 
     try:
-        with open(os.path.join('data/', file_path)) as json_file:
+        with open(os.path.join(data_path, file_path)) as json_file:
             data = json.load(json_file)
             data = convert_keys_to_lower(data)
             data = parse_obj_as(Base, data)
@@ -0,0 +1,159 @@
+import numpy as np
+
+
+# k nearest neighbor search over the samples of one representation (raw data,
+# activations or attributions). Small sets are searched exactly with batched
+# matrix products, larger ones with an inverted file index: k-means centroids
+# split the samples into lists and a query only scans the lists of its n_probe
+# closest centroids.
+#
+# Distances are euclidean, cosine distances use the same index on unit vectors.
+
+metrics = ['euclidean', 'cosine']
+
+# sets up to this size get the exact index
+exact_limit = 20000
+
+# rows per matrix product, bounds the memory of a query to chunk_size * queries
+chunk_size = 65536
+
+kmeans_iterations = 10
+kmeans_sample_size = 50000
+n_probe = 8
+
+
+def prepare_vectors(data, metric='euclidean'):
+    vectors = np.ascontiguousarray(np.asarray(data, dtype=np.float32).reshape(len(data), -1))
+    if metric == 'cosine':
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+    return vectors
+
+
+def squared_distances(queries, vectors, norms=None):
+    # |q|^2 + |x|^2 - 2 q.x for every query and vector
+    if norms is None:
+        norms = np.einsum('ij,ij->i', vectors, vectors)
+    distances = np.einsum('ij,ij->i', queries, queries)[:, None] + norms[None, :] - 2 * (queries @ vectors.T)
+    return np.maximum(distances, 0, out=distances)
+
+
+def top_k(distances, candidates, k):
+    # the k smallest distances per query (row), sorted, and their candidate ids
+    k = min(k, distances.shape[1])
+    part = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < distances.shape[1] else np.tile(np.arange(distances.shape[1]), (len(distances), 1))
+    part_distances = np.take_along_axis(distances, part, axis=1)
+    order = np.argsort(part_distances, axis=1, kind='stable')
+    return np.take_along_axis(candidates[part], order, axis=1), np.take_along_axis(part_distances, order, axis=1)
+
+
+def merge_top_k(best, found, k):
+    idc = np.concatenate([best[0], found[0]], axis=1)
+    distances = np.concatenate([best[1], found[1]], axis=1)
+    order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(idc, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+def exact_search(queries, vectors, norms, k, candidates=None):
+    if candidates is None:
+        candidates = np.arange(len(vectors))
+
+    best = (np.zeros((len(queries), 0), dtype=np.intp), np.zeros((len(queries), 0), dtype=np.float32))
+    for chunk in range(0, len(candidates), chunk_size):
+        chunk_idc = candidates[chunk:chunk + chunk_size]
+        distances = squared_distances(queries, vectors[chunk_idc], norms[chunk_idc])
+        best = merge_top_k(best, top_k(distances, chunk_idc, k), k)
+    return best
+
+
+def kmeans(vectors, n_clusters, iterations=kmeans_iterations, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(vectors, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # sum the members of every cluster with one reduceat over the sorted samples,
+        # empty clusters keep their centroid
+        order = np.argsort(assignment, kind='stable')
+        filled = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(vectors[order], starts, axis=0) / counts[filled, None]
+    return centroids
+
+
+def assign(vectors, centroids):
+    assignment = np.empty(len(vectors), dtype=np.intp)
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    for chunk in range(0, len(vectors), chunk_size):
+        assignment[chunk:chunk + chunk_size] = np.argmin(squared_distances(vectors[chunk:chunk + chunk_size], centroids, centroid_norms), axis=1)
+    return assignment
+
+
+def build_index(data, metric='euclidean', seed=0):
+    vectors = prepare_vectors(data, metric)
+    index = {
+        'kind': 'exact',
+        'metric': metric,
+        'vectors': vectors,
+        'norms': np.einsum('ij,ij->i', vectors, vectors),
+    }
+
+    if len(vectors) > exact_limit:
+        # about sqrt(N) lists, the centroids are trained on a sample
+        n_lists = int(np.sqrt(len(vectors)))
+        rng = np.random.default_rng(seed)
+        sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), kmeans_sample_size), replace=False))]
+        centroids = kmeans(sample, n_lists, seed=seed)
+
+        # samples of list l are list_idc[list_offsets[l]:list_offsets[l + 1]]
+        assignment = assign(vectors, centroids)
+        index.update({
+            'kind': 'ivf',
+            'centroids': centroids,
+            'list_idc': np.argsort(assignment, kind='stable'),
+            'list_offsets': np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]),
+        })
+
+    return index
+
+
+def search(index, queries, k, probes=n_probe):
+    # k nearest samples and their distances for every query vector
+    queries = prepare_vectors(queries, index['metric'])
+    vectors, norms = index['vectors'], index['norms']
+
+    if index['kind'] == 'exact':
+        idc, distances = exact_search(queries, vectors, norms, k)
+    else:
+        centroids = index['centroids']
+        list_idc, list_offsets = index['list_idc'], index['list_offsets']
+        probed = np.argsort(squared_distances(queries, centroids), axis=1)[:, :probes]
+
+        # lists with less than k samples pad with -1 and inf
+        idc = np.full((len(queries), k), -1, dtype=np.intp)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for q, lists in enumerate(probed):
+            candidates = np.concatenate([list_idc[list_offsets[l]:list_offsets[l + 1]] for l in lists])
+            found_idc, found_distances = exact_search(queries[q:q + 1], vectors, norms, k, candidates)
+            idc[q, :found_idc.shape[1]] = found_idc[0]
+            distances[q, :found_idc.shape[1]] = found_distances[0]
+
+    return idc, np.sqrt(distances)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    # the rendering modules import this one, only needed for the command line
+    import render as r
+
+    parser = argparse.ArgumentParser(description='Build the nearest neighbor indexes of a dataset.')
+    parser.add_argument('file_name', type=str, help='Dataset name in the data directory (e.g., resnet-forda)')
+    parser.add_argument('--stage', type=str, action='append', help='Stage to index, repeatable (default: all)')
+    parser.add_argument('--representation', type=str, action='append', choices=r.neighbor_representations, help='Representation to index, repeatable (default: all)')
+    parser.add_argument('--metric', type=str, action='append', choices=metrics, help='Metric to index, repeatable (default: all)')
+    parser.add_argument('--rebuild', action='store_true', help='Build existing indexes again')
+    args = parser.parse_args()
+
+    built = r.build_neighbor_indexes(args.file_name, args.stage, args.representation, args.metric, args.rebuild)
+    print(f'Built {len(built)} neighbor indexes for {args.file_name}')
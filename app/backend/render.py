@@ -0,0 +1,510 @@
+import os
+import time
+import shutil
+
+import numpy as np
+
+import model as m
+
+import image as i
+
+import cache as c
+
+import binary as b
+
+import envelopes as e
+
+import neighbors as n
+
+import functions as f
+
+import storage as s
+
+
+# Everything here runs either in the app process or in a render worker
+# process (see app.py), so it only takes plain arguments and opens the
+# datasets itself. Datasets are memory-mapped, the pages are shared by all
+# processes through the page cache instead of being copied.
+
+
+
+def get_data_to_show(settings):
+    settings_dict = settings.dict()
+    data_to_show = []
+    for k in settings_dict.keys():
+        if settings_dict[k] == True:
+            if 'labels' in k:
+                data_to_show.append('labels')
+                data_to_show.append('predictions')
+            else:
+                data_to_show.append(k)
+    return data_to_show
+
+
+def get_data_generation(settings):
+    # [block, normalization, colormap, only quantiles] in the order they are drawn
+    return [
+        ['raw_data', 'MinMax', settings.raw_time_series_colormap, False],
+        ['raw_data_histogram', 'Sqrt', settings.raw_time_series_histogram_colormap, False],
+        ['activations', 'MinMax', settings.activations_colormap, False],
+        ['activations_histogram', 'Sqrt', settings.activations_histogram_colormap, False],
+        ['attributions', 'MinMax', settings.attributions_colormap, True],
+        ['attributions_histogram', 'Sqrt', settings.attributions_histogram_colormap, False],
+        ['labels', 'MinMax', settings.predictions_colormap, False],
+        ['predictions', 'MinMax', settings.predictions_colormap, False]
+    ]
+
+
+def resolve_view(loaded_data, stage='', ordering_base='', ordering_method='', attribution_method=''):
+    data = loaded_data.data
+    orderings = loaded_data.orderings
+
+    if stage == '':
+        stage, _ = data.get_default()
+
+    if ordering_base == '':
+        ordering_base, _ = data.get(stage).get_default()
+
+    if ordering_method == '':
+        ordering_method, _ = orderings.get(stage).get_default(ordering_base)
+
+    if attribution_method == '':
+        attribution_method, _ = data.get(stage).get_default_attribution()
+
+    return stage, ordering_base, ordering_method, attribution_method
+
+
+def collect_data(loaded_data, stage, attribution_method):
+    # references to the stored (memory-mapped) arrays, only the rows a request shows get copied
+    return loaded_data.data.get(stage).get_blocks(attribution_method)
+
+
+def get_ordering(loaded_data, stage, ordering_base, ordering_method, attribution_method):
+    ordering = loaded_data.orderings.get(stage).get_ordering(ordering_base, ordering_method, attribution_method)
+
+    if ordering is None:
+        return np.array(range(len(loaded_data.data.get(stage).raw_data)))
+    return ordering
+
+
+def summarize(collected_data):
+    # slider summaries per sample in the natural order, permute them with order_summary
+    summary = {}
+    for k, d in collected_data.items():
+        if len(d.shape) > 1:
+            if d.shape[-1] > 10:
+                summary[k] = np.std(d, axis=1)
+            else:
+                summary[k] = np.mean(d, axis=1)
+        else:
+            summary[k] = np.array(d)
+
+    summary['None'] = np.std(collected_data['raw_data'], axis=1)
+    return summary
+
+
+def order_summary(summary, ordering):
+    return {k: v[ordering].tolist() for k, v in summary.items()}
+
+
+def get_block_widths(collected_data, settings):
+    data_to_show = get_data_to_show(settings)
+
+    widths = []
+    for k, _, _, _ in get_data_generation(settings):
+        if k in collected_data and k in data_to_show:
+            d = collected_data[k]
+            widths.append(d.shape[1] if len(d.shape) > 1 else 1)
+    return widths
+
+
+def normalized_blocks(collected_data, idc, settings, row_range=False):
+    # the shown blocks for the samples in idc, every row is normalized on its own.
+    # With row_range the min and max of every row before the normalization are
+    # yielded as well, otherwise None
+    data_to_show = get_data_to_show(settings)
+
+    for k in get_data_generation(settings):
+        k, norm, cmap, quant = k
+        if k in collected_data and k in data_to_show:
+            # idc is an index array, so the selection is already a copy normalize can overwrite
+            d = np.asarray(collected_data[k][idc], dtype=float)
+            # taken before normalize overwrites the selection
+            ranges = (np.min(d, axis=1), np.max(d, axis=1)) if row_range else None
+            # d = i.discretizer(d)
+            d = i.normalize(d, norm, out=d)
+            if quant:
+                d = i.only_quantiles(d, out=d)
+            yield k, norm, cmap, quant, d, ranges
+
+
+def render_blocks(collected_data, idc, settings):
+    # colored uint8 blocks for the samples in idc
+    return [i.data_to_color(d, cmap) for _, _, cmap, _, d, _ in normalized_blocks(collected_data, idc, settings)]
+
+
+def quantize_blocks(collected_data, idc, settings, bits=8):
+    # the normalized blocks as integer levels together with the row range of
+    # the values before normalization, so a client can color them on its own
+    blocks = {}
+    for k, norm, cmap, quant, d, (row_min, row_max) in normalized_blocks(collected_data, idc, settings, row_range=True):
+        blocks[k] = {
+            'normalization': norm,
+            'colormap': cmap,
+            'only_quantiles': quant,
+            'data': i.quantize(d, bits),
+            'nan': i.nan_positions(d),
+            'min': row_min.astype(np.float32),
+            'max': row_max.astype(np.float32),
+        }
+    return blocks
+
+
+dataset_cache_budget = int(os.environ.get('DATASET_CACHE_MB', 8192)) * 1024 * 1024
+dataset_cache = c.LRUCache('datasets', max_bytes=dataset_cache_budget)
+def load_file(file_name):
+    # keyed by the fingerprint like the derived caches, a rewritten or patched
+    # dataset is parsed again instead of mixing old blocks with new derived data
+    data = dataset_cache.get((file_name, m.get_file_fingerprint(file_name)))
+    if data is None:
+        if file_name not in m.get_all_available_files(download=False):
+            raise FileNotFoundError(f'Dataset {file_name} not found')
+        data = m.parse_file(file_name)
+        # parsing may convert a JSON dataset and change the fingerprint
+        fingerprint = m.get_file_fingerprint(file_name)
+        for key in dataset_cache.keys():
+            if key[0] == file_name and key[1] != fingerprint:
+                dataset_cache.pop(key)
+        data = dataset_cache.put((file_name, fingerprint), data)
+    return data
+
+
+summary_cache_budget = int(os.environ.get('SUMMARY_CACHE_MB', 256)) * 1024 * 1024
+summary_cache = c.LRUCache('summaries', max_bytes=summary_cache_budget)
+def get_summary(file_name, stage, attribution_method, collected_data=None):
+    # the summaries do not depend on the ordering, compute them once per stage and attribution method
+    key = (file_name, m.get_file_fingerprint(file_name), stage, attribution_method)
+    summary = summary_cache.get(key)
+    if summary is None:
+        if collected_data is None:
+            collected_data = collect_data(load_file(file_name), stage, attribution_method)
+        summary = summary_cache.put(key, summarize(collected_data))
+    return summary
+
+
+def render_summary_data(file_name, stage, ordering_base, ordering_method, attribution_method):
+    loaded_data = load_file(file_name)
+    view = resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+    stage, ordering_base, ordering_method, attribution_method = view
+
+    summary = get_summary(file_name, stage, attribution_method)
+    ordering = get_ordering(loaded_data, *view)
+
+    return {
+        'summary_data': order_summary(summary, ordering),
+
+        'cur_stage': stage,
+        'cur_attribution_method': attribution_method,
+        'cur_ordering_base': ordering_base,
+        'cur_ordering_method': ordering_method,
+    }
+
+
+def render_pixel_meta(settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method):
+
+    resolution_width = settings.resolution_width
+    resolution_height = settings.resolution_height
+
+    layout = settings.layout
+
+    print(f'General settings: {settings}')
+    
+    loaded_data = load_file(file_name)
+
+    data = loaded_data.data
+    orderings = loaded_data.orderings
+    interestingness = loaded_data.interestingness
+    
+    stage, ordering_base, ordering_method, attribution_method = resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+
+    print(f'Dataset: {file_name}, Interval: [{start}, {end}], Stage: {stage}, Method: {attribution_method}, Ordering: [{ordering_base}, {ordering_method}]')
+
+    collected_data = collect_data(loaded_data, stage, attribution_method)
+
+    orderings_defaults = orderings.get(stage).get_default_orderings()
+    orderings_defaults['attributions_histogram'] = orderings_defaults['attributions'][f'{attribution_method}_histogram']
+    orderings_defaults['attributions'] = orderings_defaults['attributions'][f'{attribution_method}']
+    orderings_defaults['None'] = ['None']
+
+    stages = data.get_set()
+    attribution_methods = data.get(stage).get_attributions()
+
+    ordering = get_ordering(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+
+    print(f'Selected Ordering: {ordering}')
+
+    interestingness_idc = interestingness.get(stage).get_interestingness(ordering_base, ordering_method, attribution_method)
+    selected_interestingness_idc = []
+    if interestingness_idc:
+        for idx in interestingness_idc:
+            if start <= idx[0][0] and idx[0][1] <= end:
+                selected_interestingness_idc.append(idx)
+
+    # slice to start and end and calculate width
+    max_samples = 0
+    sliced_ordering = np.asarray(ordering[start:end])
+
+    for k in collected_data:
+        max_samples = max(max_samples, len(collected_data[k]))
+
+    # summary data for the slider selector, kept as arrays until the response is encoded
+    summary = get_summary(file_name, stage, attribution_method, collected_data)
+    summary_data = {k: v[ordering] for k, v in summary.items()}
+
+    proportion_for_image = [w for w in get_block_widths(collected_data, settings) if w > 10]
+
+    proportion_sum = sum(proportion_for_image)
+    if layout == 'horizontal':
+        proportion_for_image_scaled = [x/proportion_sum * resolution_height for x in proportion_for_image]
+    else:
+        proportion_for_image_scaled = [x/proportion_sum * resolution_width for x in proportion_for_image]
+
+    meta = {
+        'stages': stages,
+        'attribution_methods': attribution_methods,
+        'orderings': orderings_defaults,
+
+        'cur_stage': stage,
+        'cur_attribution_method': attribution_method,
+        'cur_ordering_base': ordering_base,
+        'cur_ordering_method': ordering_method,
+
+        'max_samples': max_samples,
+
+        'summary_data': summary_data,
+        'ordering_idc': sliced_ordering,
+
+        'data_lengths': proportion_for_image,
+        'data_lengths_scaled': proportion_for_image_scaled,
+
+        'interestingness': selected_interestingness_idc,
+    }
+
+    return meta, collected_data
+
+
+def render_pixel_image(settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method, image_format='png'):
+
+    meta, collected_data = render_pixel_meta(settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method)
+
+    data_for_image = render_blocks(collected_data, meta['ordering_idc'], settings)
+    pixels = i.data_to_pixels(data_for_image, resolution=[settings.resolution_width, settings.resolution_height], direction=settings.layout)
+
+    if image_format == 'rgba':
+        image = pixels.tobytes()
+    else:
+        image = i.image_to_buffer(pixels).getvalue()
+
+    ret_tmp = {
+       'image': image,
+       'shape': list(pixels.shape),
+       'meta': meta,
+   }
+
+    return ret_tmp
+
+
+def render_pixel_meta_binary(settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method):
+    meta, _ = render_pixel_meta(settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method)
+
+    # indices as int32 and summaries as float32, the rest stays in the JSON header
+    header = {k: v for k, v in meta.items() if k not in ['summary_data', 'ordering_idc']}
+    header['summary_keys'] = list(meta['summary_data'].keys())
+
+    arrays = {'ordering_idc': meta['ordering_idc'].astype(np.int32)}
+    for k, v in meta['summary_data'].items():
+        arrays[f'summary_data.{k}'] = np.asarray(v, dtype=np.float32)
+
+    return b.pack(header, arrays)
+
+
+def render_pixel_data(settings, file_name, start, end, stage, ordering_base, ordering_method, attribution_method, bits=8):
+    loaded_data = load_file(file_name)
+    view = resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+    stage, ordering_base, ordering_method, attribution_method = view
+
+    collected_data = collect_data(loaded_data, stage, attribution_method)
+    sliced_ordering = np.asarray(get_ordering(loaded_data, *view)[start:end])
+    blocks = quantize_blocks(collected_data, sliced_ordering, settings, bits)
+
+    header = {
+        'bits': bits,
+        'blocks': [{'name': k, 'normalization': v['normalization'], 'colormap': v['colormap'], 'only_quantiles': v['only_quantiles']} for k, v in blocks.items()],
+
+        'cur_stage': stage,
+        'cur_attribution_method': attribution_method,
+        'cur_ordering_base': ordering_base,
+        'cur_ordering_method': ordering_method,
+    }
+    arrays = {'ordering_idc': sliced_ordering.astype(np.int32)}
+    for k, v in blocks.items():
+        arrays[k] = v['data']
+        arrays[f'{k}.min'] = v['min']
+        arrays[f'{k}.max'] = v['max']
+        # only blocks with NaN values carry their positions
+        if len(v['nan']) > 0:
+            arrays[f'{k}.nan'] = v['nan']
+
+    return b.pack(header, arrays)
+
+
+# selections larger than this are drawn as a density instead of single lines
+density_threshold = 1000
+time_series_modes = ['auto', 'lines', 'density']
+
+
+envelope_cache_budget = int(os.environ.get('ENVELOPE_CACHE_MB', 1024)) * 1024 * 1024
+envelope_cache = c.LRUCache('envelopes', max_bytes=envelope_cache_budget)
+def get_envelope(file_name, loaded_data, view):
+    # quantile envelope of the raw data along one ordering, built on its first brush
+    key = (file_name, m.get_file_fingerprint(file_name), *view)
+    envelope = envelope_cache.get(key)
+    if envelope is None:
+        raw_data = loaded_data.data.get(view[0]).get_block('raw_data')
+        envelope = envelope_cache.put(key, e.build_envelope(raw_data, get_ordering(loaded_data, *view)))
+    return envelope
+
+
+def selected_range(loaded_data, view, idc):
+    # [start, end) of the ordering if idc is a contiguous range of it
+    ordering = np.asarray(get_ordering(loaded_data, *view))
+    inverse = np.empty(len(ordering), dtype=np.intp)
+    inverse[ordering] = np.arange(len(ordering))
+    return e.contiguous_range(ordering, inverse, idc)
+
+
+def render_time_series(file_name, stage, idc, start, end, mode='auto', threshold=density_threshold, ordering_base='', ordering_method='', attribution_method=''):
+    loaded_data = load_file(file_name)
+    view = resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+
+    raw_data = loaded_data.data.get(view[0]).get_block('raw_data')
+
+    if start < 1 and isinstance(start, float):
+        start = start * raw_data.shape[1]
+    if end < 1 and isinstance(end, float):
+        end = end * raw_data.shape[1]
+
+    density = mode == 'density' or (mode == 'auto' and len(idc) > threshold)
+
+    # large brushes over the ordering merge their quantiles (and densities) from the envelope
+    brushed = selected_range(loaded_data, view, idc) if len(idc) >= e.min_range else None
+    if brushed is not None:
+        envelope = get_envelope(file_name, loaded_data, view)
+        histogram, min_, max_ = e.query_envelope(envelope, raw_data, get_ordering(loaded_data, *view), *brushed)
+        quantiles = e.envelope_quantiles(histogram, envelope['edges'], min_, max_, [q for q, _, _ in i.plot_quantiles])
+
+        if density:
+            return i.histogram_to_density_image(histogram, envelope['edges'], min_, max_, quantiles, start, end).getvalue()
+        return i.idc_to_image(raw_data[np.sort(idc)], start, end, quantiles=quantiles).getvalue()
+
+    selected_data = raw_data[idc]
+    if density:
+        return i.idc_to_density_image(selected_data, start, end).getvalue()
+    return i.idc_to_image(selected_data, start, end).getvalue()
+
+
+neighbor_representations = ['raw_data', 'activations', 'attributions']
+
+
+def neighbor_index_path(file_name, stage, representation, attribution_method, metric, fingerprint=None):
+    # indexes of one version of the dataset like the tiles, built offline by build_neighbor_indexes
+    if representation != 'attributions':
+        attribution_method = ''
+    if fingerprint is None:
+        fingerprint = m.get_file_fingerprint(file_name)
+    key = c.make_key(stage, representation, attribution_method, metric)
+    return os.path.join(m.data_path, file_name, 'neighbors', str(fingerprint), key)
+
+
+neighbor_cache_budget = int(os.environ.get('NEIGHBOR_CACHE_MB', 1024)) * 1024 * 1024
+neighbor_cache = c.LRUCache('neighbors', max_bytes=neighbor_cache_budget)
+def get_neighbor_index(file_name, stage, representation, attribution_method, metric):
+    # the stored index memory-mapped, shared by all workers, or None if it was not built
+    path = neighbor_index_path(file_name, stage, representation, attribution_method, metric)
+
+    index = neighbor_cache.get(path)
+    if index is None and s.is_dataset(path):
+        index = s.load_dataset(path, mmap_mode='r')
+        # arrays of tiny sets are stored inline in the manifest
+        index = {k: np.asarray(v) if isinstance(v, list) else v for k, v in index.items()}
+        index = neighbor_cache.put(path, index)
+    return index
+
+
+def build_neighbor_indexes(file_name, stages=None, representations=None, metrics=None, rebuild=False):
+    # builds and stores the missing indexes of a dataset (all stages, representations,
+    # attribution methods and metrics by default) and removes those of older versions
+    loaded_data = m.parse_file(file_name)
+    fingerprint = m.get_file_fingerprint(file_name)
+
+    base_path = os.path.join(m.data_path, file_name, 'neighbors')
+    if os.path.isdir(base_path):
+        for name in os.listdir(base_path):
+            if name != str(fingerprint):
+                shutil.rmtree(os.path.join(base_path, name), ignore_errors=True)
+
+    built = []
+    for stage in stages or loaded_data.data.get_set():
+        stage_data = loaded_data.data.get(stage)
+        for representation in representations or neighbor_representations:
+            attribution_methods = stage_data.get_attributions() if representation == 'attributions' else ['']
+            for attribution_method in attribution_methods:
+                data = stage_data.get_block(representation, attribution_method)
+                if data is None:
+                    continue
+                for metric in metrics or n.metrics:
+                    path = neighbor_index_path(file_name, stage, representation, attribution_method, metric, fingerprint)
+                    if s.is_dataset(path) and not rebuild:
+                        continue
+                    start_time = time.time()
+                    index = n.build_index(data, metric)
+                    s.save_dataset(index, path)
+                    print(f'{index["kind"]} index for {file_name} {stage} {representation} {attribution_method} {metric} built in {time.time() - start_time:.2f} seconds')
+                    built.append(path)
+    return built
+
+
+def render_nearest_neighbors(file_name, idx, k, representation, metric, stage, ordering_base, ordering_method, attribution_method):
+    loaded_data = load_file(file_name)
+    view = resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+    stage, ordering_base, ordering_method, attribution_method = view
+
+    data = loaded_data.data.get(stage).get_block(representation, attribution_method)
+    if idx < 0 or idx >= len(data):
+        raise IndexError(f'Sample {idx} not in {file_name} {stage}')
+
+    # without a built index the samples are scanned exactly, a request never builds one
+    index = get_neighbor_index(file_name, stage, representation, attribution_method, metric)
+    ordering = f.k_nearest_neighbor_ordering(idx, data, k, index, metric)
+
+    # exact distances of the few found neighbors, cosine distances from the unit vectors
+    vectors = n.prepare_vectors(data[ordering], metric)
+    distances = np.linalg.norm(vectors[1:] - vectors[0], axis=1)
+    if metric == 'cosine':
+        distances = distances ** 2 / 2
+
+    return {
+        'idx': idx,
+        'neighbors': ordering[1:].tolist(),
+        'distances': distances.tolist(),
+        'ordering_idc': ordering.tolist(),
+
+        'representation': representation,
+        'metric': metric,
+        'index': 'scan' if index is None else index['kind'],
+
+        'cur_stage': stage,
+        'cur_attribution_method': attribution_method,
+        'cur_ordering_base': ordering_base,
+        'cur_ordering_method': ordering_method,
+    }
@@ -0,0 +1,237 @@
+import os
+import re
+import errno
+import sys
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# This module exists twice, as app/backend/storage.py and preprocessing/storage.py,
+# since the backend and the preprocessing are deployed on their own. Both write
+# and read the same datasets, keep the two files identical.
+#
+# A dataset is stored as a directory with a small manifest.json holding the
+# stage/ordering/interestingness tree and one .npy file per array in it.
+#
+#   <name>/manifest.json
+#   <name>/arrays/data.train.raw_data.npy
+#   ...
+#
+# Inside the manifest every array is replaced by a reference like
+# {"__array__": "arrays/data.train.raw_data.npy", "dtype": "float64", "shape": [3601, 500]}
+
+format_name = 'davots-npy'
+format_version = 1
+
+manifest_file = 'manifest.json'
+arrays_dir = 'arrays'
+
+array_key = '__array__'
+
+# numeric lists shorter than this (e.g. scores) stay inline in the manifest
+min_array_size = 16
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, manifest_file))
+
+
+def is_array_ref(x):
+    return isinstance(x, dict) and array_key in x
+
+
+def to_numeric_array(x):
+    try:
+        arr = np.asarray(x)
+    except (ValueError, TypeError):
+        return None
+    if arr.dtype.kind not in 'biuf':
+        return None
+    return arr
+
+
+def array_file_name(key_path, used_names):
+    name = '.'.join(str(k) for k in key_path) or 'array'
+    name = re.sub(r'[^A-Za-z0-9_.\-]', '_', name)
+    base, i = name, 1
+    while name in used_names:
+        name = f'{base}.{i}'
+        i += 1
+    used_names.add(name)
+    return os.path.join(arrays_dir, f'{name}.npy')
+
+
+def tree_to_manifest(tree, path, used_names, key_path=()):
+    if isinstance(tree, dict):
+        return {k: tree_to_manifest(v, path, used_names, (*key_path, k)) for k, v in tree.items()}
+
+    if isinstance(tree, (list, tuple)):
+        arr = to_numeric_array(tree)
+        if arr is None or arr.size < min_array_size:
+            return [tree_to_manifest(v, path, used_names, (*key_path, i)) for i, v in enumerate(tree)]
+        tree = arr
+
+    if isinstance(tree, np.ndarray):
+        if tree.dtype.kind not in 'biuf':
+            return tree_to_manifest(tree.tolist(), path, used_names, key_path)
+        file_name = array_file_name(key_path, used_names)
+        np.save(os.path.join(path, file_name), np.ascontiguousarray(tree), allow_pickle=False)
+        return {array_key: file_name, 'dtype': tree.dtype.str, 'shape': list(tree.shape)}
+
+    if isinstance(tree, np.integer):
+        return int(tree)
+    if isinstance(tree, np.floating):
+        return float(tree)
+    return tree
+
+
+def manifest_to_tree(manifest, path, mmap_mode=None):
+    if is_array_ref(manifest):
+        # empty files cannot be mapped
+        if 0 in manifest['shape']:
+            mmap_mode = None
+        return np.load(os.path.join(path, manifest[array_key]), mmap_mode=mmap_mode, allow_pickle=False)
+    if isinstance(manifest, dict):
+        return {k: manifest_to_tree(v, path, mmap_mode) for k, v in manifest.items()}
+    if isinstance(manifest, list):
+        return [manifest_to_tree(v, path, mmap_mode) for v in manifest]
+    return manifest
+
+
+def staging_path(path, suffix):
+    # a new directory next to path for every writer, so processes and threads
+    # writing the same dataset at once do not share their staging directories
+    parent, name = os.path.split(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    staged = tempfile.mkdtemp(dir=parent, prefix=f'{name}.', suffix=suffix)
+    os.chmod(staged, 0o755)
+    return staged
+
+
+def save_dataset(tree, path, **meta):
+    tmp_path = staging_path(path, '.tmp')
+    old_path = None
+    try:
+        os.makedirs(os.path.join(tmp_path, arrays_dir))
+
+        manifest = {
+            'format': format_name,
+            'version': format_version,
+            **meta,
+            'tree': tree_to_manifest(tree, tmp_path, set()),
+        }
+        with open(os.path.join(tmp_path, manifest_file), 'w') as f:
+            json.dump(manifest, f)
+
+        # swap the finished directory in so readers never see a partial dataset,
+        # another writer may put its dataset in place in between, the last one wins
+        old_path = staging_path(path, '.old')
+        while True:
+            try:
+                os.replace(path, old_path)
+            except FileNotFoundError:
+                pass
+            try:
+                os.replace(tmp_path, path)
+                break
+            except OSError as error:
+                if error.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    # keep the previous dataset if ours cannot be moved in
+                    if is_dataset(old_path):
+                        os.replace(old_path, path)
+                    raise
+                shutil.rmtree(old_path, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    return path
+
+
+def manifest_arrays(manifest):
+    # file names of all arrays referenced in a manifest tree
+    if is_array_ref(manifest):
+        return [manifest[array_key]]
+    if isinstance(manifest, dict):
+        return [f for v in manifest.values() for f in manifest_arrays(v)]
+    if isinstance(manifest, list):
+        return [f for v in manifest for f in manifest_arrays(v)]
+    return []
+
+
+def set_subtree(tree, key_path, value):
+    # None removes the subtree
+    for k in key_path[:-1]:
+        if value is None and not isinstance(tree.get(k), dict):
+            return
+        tree = tree.setdefault(k, {})
+    if value is None:
+        tree.pop(key_path[-1], None)
+    else:
+        tree[key_path[-1]] = value
+
+
+def update_dataset(path, updates, **meta):
+    # replaces the subtrees at the key paths (tuples) of updates in place, None
+    # removes a subtree. New arrays get new files and the manifest is swapped in
+    # before the replaced files are removed, readers see the old or the new dataset.
+    manifest = read_manifest(path)
+    old_files = set(manifest_arrays(manifest['tree']))
+    used_names = {os.path.basename(f)[:-len('.npy')] for f in old_files}
+
+    for key_path, tree in updates.items():
+        value = None if tree is None else tree_to_manifest(tree, path, used_names, key_path)
+        set_subtree(manifest['tree'], key_path, value)
+    manifest.update(meta)
+
+    fd, tmp_file = tempfile.mkstemp(dir=path, prefix=f'{manifest_file}.', suffix='.tmp')
+    os.chmod(tmp_file, 0o644)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, os.path.join(path, manifest_file))
+
+    for file_name in old_files - set(manifest_arrays(manifest['tree'])):
+        os.remove(os.path.join(path, file_name))
+
+    return path
+
+
+def read_manifest(path):
+    with open(os.path.join(path, manifest_file)) as f:
+        manifest = json.load(f)
+
+    if manifest.get('format') != format_name:
+        raise ValueError(f'{path} is not a {format_name} dataset')
+    if manifest.get('version', 0) > format_version:
+        raise ValueError(f'{path} has unsupported version {manifest.get("version")}')
+
+    return manifest
+
+
+def load_dataset(path, mmap_mode=None):
+    manifest = read_manifest(path)
+    return manifest_to_tree(manifest['tree'], path, mmap_mode)
+
+
+def convert_json_file(json_path, path=None):
+    if path is None:
+        path = json_path[:-5] if json_path.endswith('.json') else f'{json_path}.d'
+
+    with open(json_path) as f:
+        tree = json.load(f)
+
+    return save_dataset(tree, path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} <results.json> [<output directory>]')
+        sys.exit(1)
+
+    json_path = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else None
+    print(f'Converted {json_path} to {convert_json_file(json_path, path)}')
@@ -0,0 +1,179 @@
+import os
+import shutil
+import math
+import argparse
+
+import numpy as np
+
+import model as m
+
+import image as i
+
+import render as r
+
+import cache as c
+
+
+# The pixel image of one view (stage, ordering, attribution method and the
+# shown blocks) is cut into a pyramid of tile_size x tile_size tiles like a map.
+# Samples run along y in the order of the ordering, the blocks along x.
+# The last level shows one pixel per value, every level above halves both axes.
+
+tile_size = 256
+divider_length = 1
+
+
+def tile_grid(collected_data, settings):
+    layout, width = i.block_layout(r.get_block_widths(collected_data, settings), divider_length)
+    height = len(collected_data['raw_data'])
+
+    max_level = max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+
+    return {
+        'tile_size': tile_size,
+        'levels': max_level + 1,
+        'width': width,
+        'height': height,
+        'layout': layout,
+    }
+
+
+def level_shape(grid, z):
+    step = 2 ** (grid['levels'] - 1 - z)
+    return step, math.ceil(grid['height'] / step), math.ceil(grid['width'] / step)
+
+
+def render_tile(collected_data, ordering, settings, z, x, y, grid=None):
+    if grid is None:
+        grid = tile_grid(collected_data, settings)
+
+    if z < 0 or z >= grid['levels']:
+        return None
+
+    step, level_height, level_width = level_shape(grid, z)
+    rows = np.arange(y * tile_size, min((y + 1) * tile_size, level_height))
+    cols = np.arange(x * tile_size, min((x + 1) * tile_size, level_width))
+    if len(rows) < 1 or len(cols) < 1:
+        return None
+
+    # only the rows of this tile are normalized and colored, each row is
+    # normalized on its own so the tile matches the full image
+    idc = np.asarray(ordering)[rows * step]
+    blocks = r.render_blocks(collected_data, idc, settings)
+
+    tile = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    i.compose_blocks(blocks, grid['layout'], np.arange(len(rows)), cols * step, 'vertical', out=tile[:len(rows), :len(cols)])
+
+    return i.image_to_buffer(tile).getvalue()
+
+
+def resolve_tile_view(file_name, stage, ordering_base, ordering_method, attribution_method):
+    return r.resolve_view(r.load_file(file_name), stage, ordering_base, ordering_method, attribution_method)
+
+
+def render_tile_info(file_name, settings, stage, ordering_base, ordering_method, attribution_method):
+    loaded_data = r.load_file(file_name)
+    view = r.resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+    collected_data = r.collect_data(loaded_data, view[0], view[3])
+    grid = tile_grid(collected_data, settings)
+
+    stage, ordering_base, ordering_method, attribution_method = view
+    return {
+        'tile_size': grid['tile_size'],
+        'levels': grid['levels'],
+        'width': grid['width'],
+        'height': grid['height'],
+        'data_lengths': r.get_block_widths(collected_data, settings),
+
+        'cur_stage': stage,
+        'cur_attribution_method': attribution_method,
+        'cur_ordering_base': ordering_base,
+        'cur_ordering_method': ordering_method,
+    }
+
+
+def render_view_tile(file_name, settings, stage, ordering_base, ordering_method, attribution_method, z, x, y):
+    loaded_data = r.load_file(file_name)
+    view = r.resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+    collected_data = r.collect_data(loaded_data, view[0], view[3])
+    return render_tile(collected_data, r.get_ordering(loaded_data, *view), settings, z, x, y)
+
+
+def tile_settings(settings):
+    # resolution and layout do not change tiles
+    return {k: v for k, v in settings.dict().items() if k not in ['resolution_width', 'resolution_height', 'layout']}
+
+
+def tile_view_key(stage, ordering_base, ordering_method, attribution_method, settings):
+    return c.make_key(stage, ordering_base, ordering_method, attribution_method, tile_settings(settings))
+
+
+def tiles_path(file_name, fingerprint=None):
+    # tiles of one version of the dataset, a rewritten or patched dataset gets a new fingerprint
+    if fingerprint is None:
+        fingerprint = m.get_file_fingerprint(file_name)
+    return os.path.join(m.data_path, file_name, 'tiles', str(fingerprint))
+
+
+def tile_path(file_name, view_key, z, x, y):
+    return os.path.join(tiles_path(file_name), view_key, str(z), f'{x}_{y}.png')
+
+
+def remove_stale_tiles(file_name):
+    # tiles of older versions of the dataset
+    current = tiles_path(file_name)
+    base_path = os.path.dirname(current)
+    if not os.path.isdir(base_path):
+        return
+    for name in os.listdir(base_path):
+        path = os.path.join(base_path, name)
+        if path != current:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_tile(file_name, view_key, z, x, y):
+    path = tile_path(file_name, view_key, z, x, y)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def precompute_tiles(file_name, settings, stage='', ordering_base='', ordering_method='', attribution_method='', max_level=None):
+    loaded_data = m.parse_file(file_name)
+    view = r.resolve_view(loaded_data, stage, ordering_base, ordering_method, attribution_method)
+    stage, ordering_base, ordering_method, attribution_method = view
+
+    collected_data = r.collect_data(loaded_data, stage, attribution_method)
+    ordering = r.get_ordering(loaded_data, *view)
+    grid = tile_grid(collected_data, settings)
+    view_key = tile_view_key(*view, settings)
+
+    remove_stale_tiles(file_name)
+
+    levels = grid['levels'] if max_level is None else min(grid['levels'], max_level + 1)
+    for z in range(levels):
+        _, level_height, level_width = level_shape(grid, z)
+        for y in range(math.ceil(level_height / tile_size)):
+            for x in range(math.ceil(level_width / tile_size)):
+                tile = render_tile(collected_data, ordering, settings, z, x, y, grid)
+                path = tile_path(file_name, view_key, z, x, y)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(tile)
+        print(f'Level {z} done for {file_name} {view}')
+
+    return view_key
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the pixel image tiles for a dataset.')
+    parser.add_argument('file_name', type=str, help='Dataset name in the data directory (e.g., resnet-forda)')
+    parser.add_argument('--stage', type=str, default='')
+    parser.add_argument('--ordering_base', type=str, default='')
+    parser.add_argument('--ordering_method', type=str, default='')
+    parser.add_argument('--attribution_method', type=str, default='')
+    parser.add_argument('--max_level', type=int, default=None, help='Last zoom level to precompute (default: all)')
+    args = parser.parse_args()
+
+    precompute_tiles(args.file_name, m.Settings(), args.stage, args.ordering_base, args.ordering_method, args.attribution_method, args.max_level)
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import inspect
+import hashlib
+
+from datetime import datetime
+
+import numpy as np
+
+
+# A checkpoint store keeps the orderings computed for the data blocks so a rerun
+# only computes what is missing. Every entry is addressed by a key hashed from
+# the input array, the ordering method, its parameters and the source code of the
+# method, a changed block, parameter or implementation gets a new key and misses
+# instead of reusing a stale result.
+#
+#   <path>/<key>.npy    int32 orderings x rows
+#   <path>/<key>.json   manifest of the entry: method, ordering names, data hash, ...
+#
+# Every entry has its own manifest so workers can write to the same store at
+# once. Both files are written to a temporary file first and moved in place, the
+# manifest last, an entry without its manifest does not exist.
+
+store_version = 1
+
+ordering_dtype = np.int32
+
+
+def hash_array(data):
+    data = np.ascontiguousarray(data)
+    h = hashlib.sha256()
+    h.update(f'{data.dtype.str}{data.shape}'.encode())
+    h.update(memoryview(data).cast('B'))
+    return h.hexdigest()
+
+
+def code_version(fn):
+    # the source of the module of fn, so changes to its helpers count as well
+    module = inspect.getmodule(fn)
+    source = inspect.getsource(module if module is not None else fn)
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+def checkpoint_key(data_hash, method, params=None, version=None):
+    key = json.dumps([store_version, data_hash, method, params or {}, version], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def entry_paths(path, key):
+    return os.path.join(path, f'{key}.npy'), os.path.join(path, f'{key}.json')
+
+
+def replace_atomic(tmp_path, file_path):
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+def load_checkpoint(path, key):
+    # [[name, ordering], ...] or None if there is no complete entry
+    array_path, manifest_path = entry_paths(path, key)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        orderings = np.load(array_path, allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('key') != key or list(orderings.shape) != manifest.get('shape'):
+        return None
+    return [[name, ordering] for name, ordering in zip(manifest['names'], orderings)]
+
+
+def save_checkpoint(path, key, results, **meta):
+    # results: [[name, ordering], ...] with orderings of the same length
+    os.makedirs(path, exist_ok=True)
+    array_path, manifest_path = entry_paths(path, key)
+    tmp_suffix = f'.{os.getpid()}.tmp'
+
+    names = [name for name, _ in results]
+    orderings = np.array([ordering for _, ordering in results], dtype=ordering_dtype).reshape(len(results), -1)
+
+    with open(array_path + tmp_suffix, 'wb') as f:
+        np.save(f, orderings, allow_pickle=False)
+    replace_atomic(array_path + tmp_suffix, array_path)
+
+    manifest = {
+        'key': key,
+        'names': names,
+        'shape': list(orderings.shape),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        **meta,
+    }
+    with open(manifest_path + tmp_suffix, 'w') as f:
+        json.dump(manifest, f)
+    replace_atomic(manifest_path + tmp_suffix, manifest_path)
+
+    return key
+
+
+def list_checkpoints(path):
+    manifests = []
+    if not os.path.isdir(path):
+        return manifests
+    for file_name in sorted(os.listdir(path)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, file_name)) as f:
+                manifests.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return manifests
+
+
+def invalidate_checkpoints(path, method=None, data_hash=None):
+    # removes the entries of a method and/or data block, all entries without filters
+    removed = 0
+    for manifest in list_checkpoints(path):
+        if method is not None and manifest.get('method') != method:
+            continue
+        if data_hash is not None and manifest.get('data_hash') != data_hash:
+            continue
+        array_path, manifest_path = entry_paths(path, manifest['key'])
+        # manifest first so a half removed entry is already a miss
+        for file_path in [manifest_path, array_path]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} <checkpoint directory> [<method>]')
+        sys.exit(1)
+
+    path = sys.argv[1]
+    method = sys.argv[2] if len(sys.argv) > 2 else None
+    print(f'Removed {invalidate_checkpoints(path, method)} checkpoints from {path}')
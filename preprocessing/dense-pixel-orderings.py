@@ -43,6 +43,8 @@ from models import *
 from distance_functions import *
 from measures import *
 from helpers import *
+from storage import save_dataset, update_dataset, is_dataset, read_manifest
+from scheduler import calculate_reorderings
 
 
 class TimeSeriesDataset(Dataset):
@@ -87,6 +89,13 @@ def main():
                         help='Path to save/load the model (default: data/)')
     parser.add_argument('--results_path', '-rp', type=str, default='results/', 
                         help='Path to save the results (default: results/)')
+    parser.add_argument('--output_format', '-of', type=str, default='binary',
+                        choices=['binary', 'json'],
+                        help='Format of the exported results (choose from: binary, json; default: binary)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='Number of processes computing the orderings in parallel (default: 1)')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='Only recompute the data blocks that changed since the last binary export and patch it in place')
 
     logger.info('Setting the stage')
 
@@ -97,6 +106,9 @@ def main():
     model_type = args.model
     base_data_path = args.model_path
     results_path = args.results_path
+    output_format = args.output_format
+    workers = args.workers
+    incremental = args.incremental
 
     ######## Set directories
 
@@ -377,6 +389,7 @@ def main():
     logger.info('Running the experiment')
     
     results_file_path = os.path.join(results_path, f'{model_base_name.lower()}-results.pkl')
+    checkpoint_path = os.path.join(results_path, 'checkpoints')
     results = check_savepoint(results_file_path)
 
     if results is None or results is False:
@@ -390,7 +403,42 @@ def main():
         'test': data_to_sort_test,
     }
 
+    def check_in_attributions(k):
+        for at, _ in attribution_techniques:
+            if at in k:
+                return True
+        return False
+
+    ######## Find the changed data blocks
+
+    # hash of every data block, kept in the manifest of the binary export
+    export_path = os.path.join(results_path, f'{model_base_name.lower()}-results')
+    block_hashes = {str_to_key(k): {str_to_key(d[0]): hash_array(d[1]) for d in v} for k, v in data_to_experiment_on.items()}
+
+    # None for a full export, else the names of the new or changed blocks per stage
+    changed_blocks = None
+    if incremental:
+        if output_format == 'binary' and is_dataset(export_path):
+            previous_hashes = read_manifest(export_path).get('blocks', {})
+            changed_blocks = {}
+            for k, v in data_to_experiment_on.items():
+                stage_hashes = previous_hashes.get(str_to_key(k), {})
+                changed_blocks[k] = [d[0] for d in v if stage_hashes.get(str_to_key(d[0])) != block_hashes[str_to_key(k)][str_to_key(d[0])]]
+                logger.info(f'{k}: changed blocks {changed_blocks[k]}')
+
+                # recompute the changed blocks, forget the removed ones
+                names = [d[0] for d in v]
+                for name in list(results[k].keys()):
+                    if name in changed_blocks[k] or name not in names:
+                        del results[k][name]
+        else:
+            logger.info(f'No binary export at {export_path}, running a full export')
+
+    def is_changed(stage, name):
+        return changed_blocks is not None and name in changed_blocks[stage]
+
     start_time = time.process_time()
+    blocks_to_sort = []
     for k in data_to_experiment_on:
         stage = k
         data_to_sort = data_to_experiment_on[k]
@@ -400,14 +448,19 @@ def main():
             name, d = data
             logger.info(f'{name}: {d.shape}')
 
-            name_for_file = name.lower().replace(' ', '-')
-            temp_results_path = os.path.join(results_path, f'{model_base_name.lower()}-{stage}-{name_for_file}')
-
             if name not in results[k]:
-                reordering = calculate_reordering_for_data(data, temp_results_path)
-                results[k].update(reordering)
+                if workers > 1:
+                    blocks_to_sort.append([k, name, d, checkpoint_path])
+                else:
+                    reordering = calculate_reordering_for_data(data, checkpoint_path)
+                    results[k].update(reordering)
         logger.info('')
 
+    if len(blocks_to_sort) > 0:
+        reorderings = calculate_reorderings(blocks_to_sort, workers)
+        for k, reordering in reorderings.items():
+            results[k].update(reordering)
+
     end_time = time.process_time()
     rounded_time = np.round(end_time - start_time, 10)
     logger.info(f'Time needed {rounded_time} seconds')
@@ -423,57 +476,61 @@ def main():
 
     interestingness_results = check_savepoint(interestingness_path)
     if not interestingness_results:
-        def check_in_attributions(k):
-            for at, _ in attribution_techniques:
-                if at in k:
-                    return True
-            return False
-
         interestingness_results = {}
-        start_time = time.process_time()
-        for stage, part_results in results.items():
 
-            logger.info(f'------- {stage} -------')
-            data_to_sort = data_to_experiment_on[stage]
-            data_to_sort = {d[0]: d[1] for d in data_to_sort}
+    start_time = time.process_time()
+    interestingness_changed = False
+    for stage, part_results in results.items():
 
-            interestingness_results[stage] = {'attributions': {}}
+        logger.info(f'------- {stage} -------')
+        data_to_sort = data_to_experiment_on[stage]
+        data_to_sort = {d[0]: d[1] for d in data_to_sort}
 
-            for j, v in part_results.items():
-                logger.info(f'{j} - {data_to_sort[j].shape}')
+        # forget the interestingness of removed blocks
+        stage_interestingness = interestingness_results.setdefault(str_to_key(stage), {'attributions': {}})
+        block_keys = [str_to_key(d) for d in data_to_sort]
+        for block_interestingness in [stage_interestingness, stage_interestingness['attributions']]:
+            for j in [j for j in block_interestingness if j != 'attributions' and j not in block_keys]:
+                del block_interestingness[j]
 
-                if data_to_sort[j].shape[-1] < 30:
-                    continue
+        for j, v in part_results.items():
+            logger.info(f'{j} - {data_to_sort[j].shape}')
 
-                v_d = sorted(v, key=lambda x: x[1][0])
+            if data_to_sort[j].shape[-1] < 30:
+                continue
 
-                ordering_interestingness = {}
-                for x in v_d:
-                    name, _, ordering = x
-                    tmp_data = data_to_sort[j][ordering]
-                    tmp_interestingness, tmp_binarized_data = interestingness_measure(tmp_data)
-                    interestingness_idc = data_to_interestingness_idx(tmp_binarized_data, tmp_interestingness)
+            block_interestingness = stage_interestingness['attributions'] if check_in_attributions(j) else stage_interestingness
+            if str_to_key(j) in block_interestingness and not is_changed(stage, j):
+                continue
 
-                    ordering_interestingness[str_to_key(name)] = interestingness_idc
+            v_d = sorted(v, key=lambda x: x[1][0])
 
-                    logger.info(f'Found {len(interestingness_idc)} for {name}')
+            ordering_interestingness = {}
+            for x in v_d:
+                name, _, ordering = x
+                tmp_data = data_to_sort[j][ordering]
+                tmp_interestingness, tmp_binarized_data = interestingness_measure(tmp_data)
+                interestingness_idc = data_to_interestingness_idx(tmp_binarized_data, tmp_interestingness)
 
-                if check_in_attributions(j):
-                    interestingness_results[str_to_key(stage)]['attributions'][str_to_key(j)] = ordering_interestingness
-                else:
-                    interestingness_results[str_to_key(stage)][str_to_key(j)] = ordering_interestingness
-            logger.info('')
+                ordering_interestingness[str_to_key(name)] = interestingness_idc
 
-        save_savepoint(interestingness_results, interestingness_path)
+                logger.info(f'Found {len(interestingness_idc)} for {name}')
 
-        end_time = time.process_time()
-        rounded_time = np.round(end_time - start_time, 10)
-        logger.info(f'Time needed {rounded_time} seconds')
+            block_interestingness[str_to_key(j)] = ordering_interestingness
+            interestingness_changed = True
         logger.info('')
 
-    ######## Generate JSON
+    if interestingness_changed:
+        save_savepoint(interestingness_results, interestingness_path)
+
+    end_time = time.process_time()
+    rounded_time = np.round(end_time - start_time, 10)
+    logger.info(f'Time needed {rounded_time} seconds')
+    logger.info('')
+
+    ######## Generate the export
 
-    logger.info('Generating the JSON')
+    logger.info(f'Generating the {output_format} export')
 
     data_to_json = {'data': {}, 'orderings': {}, 'interestingness': {}}
 
@@ -549,12 +606,32 @@ def main():
                         d = None
                     logger.info(f'{k} -> {l} -> {m}: {d}')
 
-    json_data = json.dumps(data_to_json, cls=NumpyArrayEncoder)
-    json_path = os.path.join(results_path, f'{model_base_name.lower()}-results.json')
-    with open(json_path, 'w') as f:
-        f.write(json_data)
+    if output_format == 'json':
+        json_data = json.dumps(data_to_json, cls=NumpyArrayEncoder)
+        export_path = os.path.join(results_path, f'{model_base_name.lower()}-results.json')
+        with open(export_path, 'w') as f:
+            f.write(json_data)
+    elif changed_blocks is not None:
+        # replace the data, orderings and interestingness of the changed and removed blocks
+        updates = {}
+        for k in block_hashes:
+            previous_names = set(previous_hashes.get(k, {}).keys())
+            for j in set(block_hashes[k].keys()) | previous_names:
+                if j in previous_names and j in block_hashes[k] and previous_hashes[k][j] == block_hashes[k][j]:
+                    continue
+                for part in ['data', 'orderings', 'interestingness']:
+                    for key_path in [(part, k, j), (part, k, 'attributions', j)]:
+                        tree = data_to_json[part]
+                        for key in key_path[1:]:
+                            tree = tree.get(key) if isinstance(tree, dict) else None
+                        # the other location of the block is removed
+                        updates[key_path] = tree
+        logger.info(f'Patching {len([u for u in updates.values() if u is not None])} parts of {export_path}')
+        update_dataset(export_path, updates, blocks=block_hashes)
+    else:
+        save_dataset(data_to_json, export_path, blocks=block_hashes)
 
-    logger.info(f'All done at {json_path}!')
+    logger.info(f'All done at {export_path}!')
     end_time = time.process_time()
     rounded_time = np.round(end_time - overall_time, 10)
     logger.info(f'Time needed {rounded_time} seconds')
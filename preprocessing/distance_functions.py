@@ -80,4 +80,197 @@ def manhattan(a, b):
 
 def hellinger(p, q):
     """ Hellinger distance between distributions """
-    return sum([(np.sqrt(t[0]) - np.sqrt(t[1])) * (np.sqrt(t[0]) - np.sqrt(t[1])) for t in zip(p,q)]) / np.sqrt(2.)
+    return np.sum((np.sqrt(p) - np.sqrt(q)) ** 2) / np.sqrt(2.)
+
+
+################################################################################
+# Matrix level distances, the same values as the functions above for all pairs
+# of rows at once with a few matrix products instead of one call per pair.
+
+
+def row_sums(data):
+    return np.sum(data, axis=1, keepdims=True)
+
+
+def standardized_row_sums(data):
+    mean = np.mean(data, axis=1, keepdims=True)
+    std = np.std(data, axis=1, keepdims=True)
+    return np.sum((data - mean) / std, axis=1, keepdims=True)
+
+
+def max_scaled_rows(data):
+    return data / (np.amax(data, axis=1, keepdims=True) + eps)
+
+
+def unit_rows(data):
+    return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+
+def centered_unit_rows(data):
+    return unit_rows(data - np.mean(data, axis=1, keepdims=True))
+
+
+def ranked_rows(data):
+    return centered_unit_rows(sp.stats.rankdata(data, axis=1))
+
+
+# metric: how rows are prepared and how two prepared rows are combined
+#   'difference'  |a - b| of the row sums
+#   'squared'     sum((a - b) ** 2) via |a|^2 + |b|^2 - 2 a.b
+#   'dot'         a.b
+#   'cityblock'   sum(|a - b|)
+distance_metrics = {
+    'euclidean': (row_sums, 'difference'),
+    'z_normalized_euclidean': (standardized_row_sums, 'difference'),
+    'normalized_euclidean': (max_scaled_rows, 'squared'),
+    'hellinger': (np.sqrt, 'squared'),
+    'cosine': (unit_rows, 'dot'),
+    'pearson': (centered_unit_rows, 'dot'),
+    'spearman': (ranked_rows, 'dot'),
+    'manhattan': (lambda data: data, 'cityblock'),
+}
+
+# metrics of similarities, the diagonal is 1 instead of 0
+similarity_metrics = ['pearson', 'spearman']
+
+metric_names = {
+    euclidean: 'euclidean',
+    normalized_euclidean: 'normalized_euclidean',
+    z_normalized_euclidean: 'z_normalized_euclidean',
+    cosine: 'cosine',
+    pearson: 'pearson',
+    spearman: 'spearman',
+    manhattan: 'manhattan',
+    hellinger: 'hellinger',
+}
+
+
+def get_metric_name(dist_fn):
+    # None for distance functions without a matrix version (e.g. dtw)
+    if isinstance(dist_fn, str):
+        return dist_fn if dist_fn in distance_metrics else None
+    return metric_names.get(dist_fn)
+
+
+def prepare_rows(data, metric):
+    data = np.asarray(data, dtype=float)
+    if len(data.shape) == 1:
+        data = data.reshape(-1, 1)
+    prepare, _ = distance_metrics[metric]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return prepare(data)
+
+
+def finish_distances(dist, metric, length):
+    if metric == 'normalized_euclidean':
+        return np.sqrt(dist) / length
+    if metric == 'hellinger':
+        return dist / np.sqrt(2.)
+    if metric == 'cosine':
+        return 1 - dist
+    if metric in similarity_metrics:
+        return np.clip(dist, -1, 1)
+    return dist
+
+
+def combine_rows(a, b, metric):
+    # all pairs of prepared rows
+    _, kind = distance_metrics[metric]
+    if kind == 'difference':
+        dist = np.abs(a - b.T)
+    elif kind == 'squared':
+        dist = np.einsum('ij,ij->i', a, a)[:, None] + np.einsum('ij,ij->i', b, b)[None, :] - 2 * (a @ b.T)
+        np.maximum(dist, 0, out=dist)
+    elif kind == 'dot':
+        dist = a @ b.T
+    else:
+        dist = sp.spatial.distance.cdist(a, b, metric='cityblock')
+    return finish_distances(dist, metric, a.shape[1] if metric == 'normalized_euclidean' else None)
+
+
+def combine_paired_rows(a, b, metric):
+    # row i of a with row i of b
+    _, kind = distance_metrics[metric]
+    if kind == 'difference':
+        dist = np.abs(a - b)[:, 0]
+    elif kind == 'squared':
+        dist = np.sum((a - b) ** 2, axis=1)
+    elif kind == 'dot':
+        dist = np.einsum('ij,ij->i', a, b)
+    else:
+        dist = np.sum(np.abs(a - b), axis=1)
+    return finish_distances(dist, metric, a.shape[1] if metric == 'normalized_euclidean' else None)
+
+
+def pairwise_distances(a, b=None, metric='normalized_euclidean', block_size=1024):
+    # len(a) x len(b) distances (b defaults to a), computed in blocks of block_size
+    # rows of a so at most block_size x len(b) intermediate values are alive
+    prepared_a = prepare_rows(a, metric)
+    prepared_b = prepared_a if b is None else prepare_rows(b, metric)
+
+    dist = np.empty((len(prepared_a), len(prepared_b)), dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(prepared_a), block_size):
+            dist[start:start + block_size] = combine_rows(prepared_a[start:start + block_size], prepared_b, metric)
+
+    # a row has distance 0 (similarity 1) to itself, as computed by the functions above
+    if b is None and len(dist) > 0:
+        identical = np.all(np.isfinite(prepared_a), axis=1)
+        self_distance = 1 if metric in similarity_metrics else 0
+        dist[np.diag_indices(len(dist))] = np.where(identical, self_distance, np.nan)
+
+    return dist
+
+
+def paired_distances(a, b, metric='normalized_euclidean'):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return combine_paired_rows(prepare_rows(a, metric), prepare_rows(b, metric), metric)
+
+
+def banded_distances(data, offsets, dist_fn=normalized_euclidean):
+    # band[k, i] = dist_fn(data[i], data[i + offsets[k]]), nan where i + offsets[k] is outside,
+    # dist_fn is a distance function or metric name, others fall back to a loop over the band
+    data = np.asarray(data)
+    n = len(data)
+    band = np.full((len(offsets), n), np.nan)
+
+    metric = get_metric_name(dist_fn)
+    if metric is None:
+        for k, offset in enumerate(offsets):
+            for i in range(max(0, -offset), min(n, n - offset)):
+                band[k, i] = dist_fn(data[i], data[i + offset])
+        return band
+
+    return banded_prepared_distances(prepare_rows(data, metric), offsets, metric)
+
+
+def banded_prepared_distances(prepared, offsets, metric):
+    # banded_distances of rows already prepared with prepare_rows
+    n = len(prepared)
+    band = np.full((len(offsets), n), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k, offset in enumerate(offsets):
+            if abs(offset) >= n:
+                continue
+            if offset >= 0:
+                band[k, :n - offset] = combine_paired_rows(prepared[:n - offset], prepared[offset:], metric)
+            else:
+                band[k, -offset:] = combine_paired_rows(prepared[-offset:], prepared[:n + offset], metric)
+    return band
+
+
+def upper_distances(data, dist_fn=normalized_euclidean):
+    # dist[i, j] = dist_fn(data[i], data[j]) for j >= i and 0 below the diagonal,
+    # the matrix the pairwise loops build, falls back to the loop for other functions
+    data = np.asarray(data)
+    n = len(data)
+
+    metric = get_metric_name(dist_fn)
+    if metric is not None:
+        return np.triu(pairwise_distances(data, metric=metric))
+
+    dist = np.zeros((n, n), dtype=float)
+    for i in range(n):
+        for j in range(i, n):
+            dist[i, j] = dist_fn(data[i], data[j])
+    return dist
@@ -53,15 +53,7 @@ def main():
         
             start_time = time.process_time()
             
-            if len(data.shape) == 2:
-                n, _ = data.shape
-            else:
-                n = len(data)
-        
-            dist = np.zeros((n, n), dtype=float)
-            for i in range(n):
-                for j in range(i, n):
-                    dist[i, j] = dist_fn(data[i], data[j])
+            dist = upper_distances(data, dist_fn)
         
             end_time = time.process_time()
             rounded_time = np.round(end_time - start_time, 10)
@@ -9,6 +9,7 @@ import torch.nn as nn
 
 from orderings import * 
 from measures import *
+from checkpoints import hash_array, code_version, checkpoint_key, load_checkpoint, save_checkpoint
 
 
 def create_hist(data, with_range=False):
@@ -33,101 +34,61 @@ def create_hist(data, with_range=False):
     return data_hist
 
 
-def calculate_reordering_for_data(data, chk_pt_path):
-    results = {}
-
-    name, data = data
-    if name not in results:
-        results[name] = []
+# ordering families computed for every data block, keyed by the suffix of their savepoint
+ordering_families = {
+    'naive': naive_sorting,
+    'feature': feature_sorting,
+    'projection': projection_sorting,
+    'clustering': clustering_sorting,
+    'reduced-clustering': reduced_clustering_sorting,
+}
 
-    start_time = time.process_time()
-
-    # Base
-    data_tmp = data.copy()
-    sorted_ind = np.arange(data_tmp.shape[0])
-    dist = calculate_scores(data_tmp[sorted_ind])
-    name_r = 'Base Distances'
-    print(f'{name_r:50}', dist)
-    results[name].append(['Base', dist, sorted_ind])
 
-    # Naive Sorting
+def calculate_ordering_family(family, data, checkpoint_path):
+    # [name, scores, ordering] for every ordering of one family, 'base' is the
+    # identity ordering, the others are loaded from or stored to the checkpoint store
     data_tmp = data.copy()
-    savepoint_path = f'{chk_pt_path}-naive.pkl'
-    saved = check_savepoint(savepoint_path)
-    if not saved:
-        name_r, sorted_ind = naive_sorting(data_tmp)
-        dist = calculate_scores(data_tmp[sorted_ind])
-        save_savepoint([name_r, dist, sorted_ind], savepoint_path)
-    else:
-        name_r, _, sorted_ind = saved
-        dist = calculate_scores(data_tmp[sorted_ind])
-    print(f'{name_r:50}', dist)
-    results[name].append([name_r, dist, sorted_ind])
-    del data_tmp
 
-    # Feature Sorting
-    data_tmp = data.copy()
-    savepoint_path = f'{chk_pt_path}-feature.pkl'
-    saved = check_savepoint(savepoint_path)
-    if not saved:
-        multiple_results = feature_sorting(data_tmp)
-        save_savepoint(multiple_results, savepoint_path)
-    else:
-        multiple_results = saved
-    for r in multiple_results:
-        name_r, sorted_ind = r
+    if family == 'base':
+        sorted_ind = np.arange(data_tmp.shape[0])
         dist = calculate_scores(data_tmp[sorted_ind])
+        name_r = 'Base Distances'
         print(f'{name_r:50}', dist)
-        results[name].append([name_r, dist, sorted_ind])
-    del data_tmp
-
-    # Projection
-    data_tmp = data.copy()
-    savepoint_path = f'{chk_pt_path}-projection.pkl'
-    saved = check_savepoint(savepoint_path)
-    if not saved:
-        multiple_results = projection_sorting(data_tmp)
-        save_savepoint(multiple_results, savepoint_path)
-    else:
-        multiple_results = saved
-    for r in multiple_results:
+        return [['Base', dist, sorted_ind]]
+
+    family_fn = ordering_families[family]
+    data_hash = hash_array(data_tmp)
+    version = code_version(family_fn)
+    key = checkpoint_key(data_hash, family, version=version)
+
+    multiple_results = load_checkpoint(checkpoint_path, key)
+    if multiple_results is None:
+        multiple_results = family_fn(data_tmp)
+        # naive sorting returns its single ordering
+        if family == 'naive':
+            multiple_results = [multiple_results]
+        save_checkpoint(checkpoint_path, key, multiple_results, method=family, data_hash=data_hash, code_version=version)
+
+    family_results = []
+    family_scores = calculate_scores_batch(data_tmp, [sorted_ind for _, sorted_ind in multiple_results])
+    for r, dist in zip(multiple_results, family_scores):
         name_r, sorted_ind = r
-        dist = calculate_scores(data_tmp[sorted_ind])
         print(f'{name_r:50}', dist)
-        results[name].append([name_r, dist, sorted_ind])
-    del data_tmp
+        family_results.append([name_r, dist, sorted_ind])
+    return family_results
 
-    # Clustering
-    data_tmp = data.copy()
-    savepoint_path = f'{chk_pt_path}-clustering.pkl'
-    saved = check_savepoint(savepoint_path)
-    if not saved:
-        multiple_results = clustering_sorting(data_tmp)
-        save_savepoint(multiple_results, savepoint_path)
-    else:
-        multiple_results = saved
-    for r in multiple_results:
-        name_r, sorted_ind = r
-        dist = calculate_scores(data_tmp[sorted_ind])
-        print(f'{name_r:50}', dist)
-        results[name].append([name_r, dist, sorted_ind])
-    del data_tmp
 
-    # Reduced clustering
-    data_tmp = data.copy()
-    savepoint_path = f'{chk_pt_path}-reduced-clustering.pkl'
-    saved = check_savepoint(savepoint_path)
-    if not saved:
-        multiple_results = reduced_clustering_sorting(data_tmp)
-        save_savepoint(multiple_results, savepoint_path)
-    else:
-        multiple_results = saved
-    for r in multiple_results:
-        name_r, sorted_ind = r
-        dist = calculate_scores(data_tmp[sorted_ind])
-        print(f'{name_r:50}', dist)
-        results[name].append([name_r, dist, sorted_ind])
-    del data_tmp
+def calculate_reordering_for_data(data, checkpoint_path):
+    results = {}
+
+    name, data = data
+    if name not in results:
+        results[name] = []
+
+    start_time = time.process_time()
+
+    for family in ['base', *ordering_families]:
+        results[name].extend(calculate_ordering_family(family, data, checkpoint_path))
 
     end_time = time.process_time()
     rounded_time = np.round(end_time - start_time, 10)
@@ -147,12 +108,14 @@ def check_savepoint(file_path):
 
 
 def save_savepoint(data, file_path):
-    if os.path.exists(file_path):
-        return False
-    else:
-        with open(file_path, 'wb') as file:
-            dill.dump(data, file)
-        return True
+    # written next to the savepoint and moved over it, an interrupted run never leaves a truncated file
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        dill.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, file_path)
+    return True
 
 
 def get_possible_layers(model):
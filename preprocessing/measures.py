@@ -1,9 +1,8 @@
 import time
 import traceback
 
+from scipy import ndimage
 from scipy.stats import entropy
-from scipy.signal import convolve2d
-from scipy.ndimage import convolve
 
 from logger import logger
 
@@ -11,29 +10,30 @@ from distance_functions import *
 
 
 def neighborhood_dist(data, neighborhood=10, dist_fn=normalized_euclidean):
-    if len(data.shape) == 2:
-        n, _ = data.shape
-    else:
-        n = len(data)
+    # sum of the distances dist[r, c], c >= r, inside the window [i - neighborhood, i + neighborhood)
+    # of every row i. A window spans at most 2 * neighborhood rows, so only the diagonals
+    # c - r < 2 * neighborhood are needed and they are summed per window from prefix sums.
+    offsets = np.arange(min(2 * neighborhood, len(data)))
+    return neighborhood_window_sum(banded_distances(data, offsets, dist_fn), neighborhood)
 
-    dist = np.empty((n, n), dtype=float)
-    dist[:] = np.nan
 
-    for i in range(n):
-        for j in range(-neighborhood * 2, neighborhood * 2):
-            j += i
-            if j >= n or j < 0: continue
-            if j < i:
-                dist[i, j] = 0
-            if np.isnan(dist[i, j]):
-                dist[i, j] = dist_fn(data[i], data[j])
+def neighborhood_window_sum(band, neighborhood=10):
+    # band[d, r] = dist[r, r + d] for the diagonals d < 2 * neighborhood
+    offsets = np.arange(len(band))
+    n = band.shape[1]
+    rows = np.arange(n)
+    # pairs past the last row are never inside a window
+    band[rows[None, :] + offsets[:, None] >= n] = 0
+    prefix = np.zeros((len(offsets), n + 1), dtype=float)
+    np.cumsum(band, axis=1, out=prefix[:, 1:])
 
-    neighborhood_sum = 0
-    for i in range(n):
-        lower = max(0, i - neighborhood)
-        upper = min(i + neighborhood, n)
-        neighborhood_sum += np.sum(dist[lower:upper, lower:upper])
-    return neighborhood_sum
+    lower = np.maximum(0, rows - neighborhood)
+    upper = np.minimum(rows + neighborhood, n)
+
+    # rows lower..upper - 1 - d start a pair at distance d inside the window
+    ends = np.maximum(upper[None, :] - offsets[:, None], lower[None, :])
+    window_sums = np.take_along_axis(prefix, ends, axis=1) - prefix[:, lower]
+    return np.sum(window_sums)
 
 
 def neighborhood_dist_naive(data, neighborhood=10, dist_fn=normalized_euclidean):
@@ -42,10 +42,7 @@ def neighborhood_dist_naive(data, neighborhood=10, dist_fn=normalized_euclidean)
     else:
         n = len(data)
 
-    dist = np.zeros((n, n), dtype=float)
-    for i in range(n):
-        for j in range(i, n):
-            dist[i, j] = dist_fn(data[i], data[j])
+    dist = upper_distances(data, dist_fn)
 
     neighborhood_sum = 0
     for i in range(n):
@@ -56,20 +53,10 @@ def neighborhood_dist_naive(data, neighborhood=10, dist_fn=normalized_euclidean)
 
 
 def baseline_convolution(data):
-    t = data.copy()
-
-    n = min(max(3, int(t.shape[0] * 0.1)), 10)
-    m = min(max(3, int(t.shape[1] * 0.1)), 10)
-
-    kernel = np.zeros((n, m))
-    kernel[:,:] = -1
-    middle_row = n // 2
-    middle_column = m // 2
-    kernel[middle_row, middle_column] = n * m - 1
-
-    t = (t - np.min(t)) / (np.max(t) - np.min(t))
-    t_r = convolve2d(t, kernel, mode='full', boundary='wrap')
-    return t_r.sum()
+    # sum of convolve2d(t, kernel, mode='full', boundary='wrap') without the convolution,
+    # see convolution_sums
+    t = (data - np.min(data)) / (np.max(data) - np.min(data))
+    return convolution_sums(t, [np.arange(len(t))])[0]
 
 
 def baseline_entropy(data, neighborhood_size=10):
@@ -94,7 +81,7 @@ def baseline_entropy(data, neighborhood_size=10):
     data_entropy = []
     random_entropy = []
 
-    for i in range(int(data_len / complete_neighborhood_size) + 1):
+    for i in range(int(np.ceil(data_len / complete_neighborhood_size))):
 
         tmp_data = data_tmp[i*complete_neighborhood_size:(i+1)*complete_neighborhood_size]
         tmp_random = random_data[i*complete_neighborhood_size:(i+1)*complete_neighborhood_size]
@@ -105,76 +92,131 @@ def baseline_entropy(data, neighborhood_size=10):
     return np.sum(data_entropy), np.sum(random_entropy)
 
 
-def calculate_scores(data):
+def convolution_kernel(shape):
+    # kernel of baseline_convolution
+    n = min(max(3, int(shape[0] * 0.1)), 10)
+    m = min(max(3, int(shape[1] * 0.1)), 10)
+
+    kernel = np.zeros((n, m))
+    kernel[:,:] = -1
+    kernel[n // 2, m // 2] = n * m - 1
+    return kernel
+
+
+def wrap_multiplicities(length, kernel_length):
+    # [k, i]: how often index i is read with kernel offset k by a full convolution with wrapped boundaries
+    positions = np.arange(length + kernel_length - 1)
+    return np.array([np.bincount((positions - k) % length, minlength=length) for k in range(kernel_length)])
+
+
+def convolution_sums(t, orderings):
+    # sum of the full convolution with wrapped boundaries of t[ordering] with the
+    # kernel of baseline_convolution for every ordering. Every output is a sum over
+    # kernel offsets k, so the total is sum_k kernel[k] * a_k^T t b_k with a_k / b_k
+    # how often each row / column is read with offset k, an ordering only gathers
+    # a rows x kernel rows matrix.
+    kernel = convolution_kernel(t.shape)
+    row_weights = wrap_multiplicities(t.shape[0], kernel.shape[0]).T
+    column_weights = wrap_multiplicities(t.shape[1], kernel.shape[1]).T @ kernel.T
+    weighted_rows = t @ column_weights
+    return [np.sum(row_weights * weighted_rows[ordering]) for ordering in orderings]
+
+
+def entropy_chunks(data, row_min, row_max, ordering, chunk_size, num_bins=100):
+    # summed entropy of the value histograms of the chunks of chunk_size rows of data[ordering], like baseline_entropy
+    chunks = int(np.ceil(len(ordering) / chunk_size))
+    bins = np.empty((len(ordering), data.shape[1]), dtype=np.intp)
+    for c in range(chunks):
+        rows = ordering[c * chunk_size:(c + 1) * chunk_size]
+        bin_edges = np.linspace(np.min(row_min[rows]), np.max(row_max[rows]), num=num_bins + 1)
+        bins[c * chunk_size:(c + 1) * chunk_size] = np.digitize(data[rows], bin_edges) + c * (num_bins + 2)
+
+    counts = np.bincount(bins.ravel(), minlength=chunks * (num_bins + 2)).reshape(chunks, num_bins + 2)
+    probabilities = counts / np.sum(counts, axis=1, keepdims=True)
+    return np.sum(sp.special.entr(probabilities))
+
+
+def calculate_scores_batch(data, orderings, neighborhood=10, neighborhood_size=10):
+    # calculate_scores(data[ordering]) for every ordering. The work that does not
+    # depend on the ordering is done once: the normalized rows of the neighborhood
+    # distance, the convolution weights and the row ranges of the entropy histograms.
+    data = np.asarray(data)
+    n = len(data)
+    scores = [[None, None, None] for _ in orderings]
+
     start_time = time.process_time()
     try:
-        neighborhood_score = neighborhood_dist(data)
+        prepared = prepare_rows(data, 'normalized_euclidean')
+        offsets = np.arange(min(2 * neighborhood, n))
+        for s, ordering in enumerate(orderings):
+            band = banded_prepared_distances(prepared[ordering], offsets, 'normalized_euclidean')
+            scores[s][0] = neighborhood_window_sum(band, neighborhood)
     except Exception as e:
-        traceback_str = traceback.format_exc()
         logger.info(f'[E] Exception: {e}')
-        logger.info(traceback_str)
-        logger.info(f'Problem with: {data}')
-        neighborhood_score = None
+        logger.info(traceback.format_exc())
     end_time = time.process_time()
     rounded_time = np.round(end_time - start_time, 10)
-    logger.info(f'Time needed {rounded_time} seconds for neighboorhood measure')
+    logger.info(f'Time needed {rounded_time} seconds for neighboorhood measure of {len(orderings)} orderings')
 
     start_time = time.process_time()
     try:
-        convolution_score = baseline_convolution(data)
+        t = (data - np.min(data)) / (np.max(data) - np.min(data))
+        for s, convolution_score in enumerate(convolution_sums(t, orderings)):
+            scores[s][1] = convolution_score
     except Exception as e:
-        traceback_str = traceback.format_exc()
         logger.info(f'[E] Exception: {e}')
-        logger.info(traceback_str)
-        logger.info(f'Problem with: {data}')
-        convolution_score = None
+        logger.info(traceback.format_exc())
     end_time = time.process_time()
     rounded_time = np.round(end_time - start_time, 10)
-    logger.info(f'Time needed {rounded_time} seconds for convolution measure')
+    logger.info(f'Time needed {rounded_time} seconds for convolution measure of {len(orderings)} orderings')
 
     start_time = time.process_time()
     try:
-        entropy_score = baseline_entropy(data)
+        row_min = np.min(data, axis=1)
+        row_max = np.max(data, axis=1)
+        chunk_size = neighborhood_size * 2
+        for s, ordering in enumerate(orderings):
+            ordering = np.asarray(ordering)
+            # one permutation per ordering in the same order as baseline_entropy draws them
+            random_idc = np.random.permutation(np.arange(n))
+            data_entropy = entropy_chunks(data, row_min, row_max, ordering, chunk_size)
+            random_entropy = entropy_chunks(data, row_min, row_max, ordering[random_idc], chunk_size)
+            scores[s][2] = (data_entropy, random_entropy)
     except Exception as e:
-        traceback_str = traceback.format_exc()
         logger.info(f'[E] Exception: {e}')
-        logger.info(traceback_str)
-        logger.info(f'Problem with: {data}')
-        entropy_score = None
+        logger.info(traceback.format_exc())
     end_time = time.process_time()
     rounded_time = np.round(end_time - start_time, 10)
-    logger.info(f'Time needed {rounded_time} seconds for entropy measure')
+    logger.info(f'Time needed {rounded_time} seconds for entropy measure of {len(orderings)} orderings')
 
-    return neighborhood_score, convolution_score, entropy_score
+    return [tuple(score) for score in scores]
+
+
+def calculate_scores(data):
+    return calculate_scores_batch(data, [np.arange(len(data))])[0]
 
 
 ################################################################################
 
 
 def only_quantiles(data, axis=1, quant_range=0.1, fill=None, only_upper=False):
-    def quant(data):
-        lower_bound = np.quantile(data, quant_range)
-        upper_bound = np.quantile(data, 1 - quant_range)
-
-        filler = fill
-        if filler is None:
-            if only_upper:
-                filler = upper_bound
-            else:
-                filler = (np.max(data) - np.min(data)) / 2
-
-        data_new = np.copy(data)
+    # per row (or the whole array with axis=-1) the values between the quantiles are replaced by fill
+    reduce_axis = None if axis == -1 else 1
+    lower_bound = np.quantile(data, quant_range, axis=reduce_axis, keepdims=True)
+    upper_bound = np.quantile(data, 1 - quant_range, axis=reduce_axis, keepdims=True)
+
+    filler = fill
+    if filler is None:
         if only_upper:
-            data_new[data_new < upper_bound] = filler
+            filler = upper_bound
         else:
-            data_new[(data_new > lower_bound) & (upper_bound > data_new)] = filler
-
-        return data_new
+            filler = (np.max(data, axis=reduce_axis, keepdims=True) - np.min(data, axis=reduce_axis, keepdims=True)) / 2
 
-    if axis == -1:
-        return quant(data)
+    if only_upper:
+        mask = data < upper_bound
     else:
-        return np.apply_along_axis(quant, 1, data)
+        mask = (data > lower_bound) & (upper_bound > data)
+    return np.where(mask, filler, data).astype(data.dtype, copy=False)
 
 
 def minmax_norm(data):
@@ -188,8 +230,14 @@ def minmax_norm(data):
 def norm(data, axis=1):
     if axis == -1 or len(data.shape) == 1:
         return minmax_norm(data)
-    else:
-        return np.apply_along_axis(minmax_norm, axis, data)
+
+    # minmax_norm of every slice along axis, constant slices become 1
+    max_ = np.max(data, axis=axis, keepdims=True)
+    min_ = np.min(data, axis=axis, keepdims=True)
+    constant = max_ == min_
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normed = (data - min_) / (max_ - min_)
+    return np.where(constant, 1, normed)
 
 
 def flip(data):
@@ -197,40 +245,74 @@ def flip(data):
     return np.abs(data - mean) + mean
 
 
-def gaussian_kernel(size: int, sigma: float) -> np.ndarray:
+def gaussian_kernel_1d(size: int, sigma: float) -> np.ndarray:
     """
-    Generates a 2D Gaussian kernel.
+    Generates a 1D Gaussian kernel.
     
     Parameters:
     size (int): The size of the kernel (must be an odd number).
     sigma (float): The standard deviation of the Gaussian.
     
     Returns:
-    np.ndarray: 2D Gaussian kernel.
+    np.ndarray: 1D Gaussian kernel.
     """
     # Ensure the size is odd to have a center
     if size % 2 == 0:
         raise ValueError("Size must be an odd number.")
 
-    # Create an (size x size) grid of (x, y) coordinates
     ax = np.arange(-size // 2 + 1, size // 2 + 1)
-    xx, yy = np.meshgrid(ax, ax)
-
-    # Calculate the Gaussian function
-    kernel = np.exp(-(xx**2 + yy**2) / (2 * sigma**2))
+    kernel = np.exp(-ax**2 / (2 * sigma**2))
 
     # Normalize the kernel to make the sum of all elements equal to 1
-    kernel = kernel / np.sum(kernel)
+    return kernel / np.sum(kernel)
+
+
+def gaussian_kernel(size: int, sigma: float) -> np.ndarray:
+    """
+    Generates a 2D Gaussian kernel.
+    
+    Parameters:
+    size (int): The size of the kernel (must be an odd number).
+    sigma (float): The standard deviation of the Gaussian.
+    
+    Returns:
+    np.ndarray: 2D Gaussian kernel.
+    """
+    # the outer product of the 1D kernel, exp(-(x² + y²)) = exp(-x²) * exp(-y²)
+    kernel = gaussian_kernel_1d(size, sigma)
+    return np.outer(kernel, kernel)
+
+
+def convolve_same(data, kernel):
+    # convolve(data, kernel, mode='constant', cval=0.0), kernel is a 2D array or the
+    # pair of 1D factors (rows, columns) of a separable kernel, which is convolved
+    # in two 1D passes with 2k instead of k² multiplications per value
+    if isinstance(kernel, tuple):
+        smoothed = ndimage.convolve1d(data, kernel[0], axis=0, mode='constant', cval=0.0)
+        return ndimage.convolve1d(smoothed, kernel[1], axis=1, mode='constant', cval=0.0)
+    return ndimage.convolve(data, kernel, mode='constant', cval=0.0)
 
-    return kernel.round(3)
 
+# rows per stripe of convolution_binarize, bounds the memory of the smoothed data
+stripe_rows = 4096
 
-def convolution_binarize(data, neighboorhoodsize=None):
-    t = data.copy()
-    t -= np.mean(t)
+# smoothed values are rounded to this fraction of the data range before the
+# thresholding, so values that only differ by rounding errors of the convolution
+# (e.g. plateaus of sparse or constant data) are ties in every convolution path
+snap_precision = 1e-10
 
+
+def snap(data, resolution):
+    if resolution <= 0:
+        return data
+    np.divide(data, resolution, out=data)
+    np.round(data, out=data)
+    return np.multiply(data, resolution, out=data)
+
+
+def convolution_binarize(data, neighboorhoodsize=None, separable=True, stripe_rows=stripe_rows):
     if neighboorhoodsize == None:
-        neighboorhoodsize = int(t.shape[-1] * 0.02)
+        neighboorhoodsize = int(data.shape[-1] * 0.02)
 
     if neighboorhoodsize % 2 == 0:
         neighboorhoodsize += 1
@@ -252,11 +334,29 @@ def convolution_binarize(data, neighboorhoodsize=None):
     # smoothed_data = convolve2d(t, kernel, mode='full', boundary='symm')
 
     sigma = neighboorhoodsize // 4
-    kernel = gaussian_kernel(neighboorhoodsize, sigma)
-
-    smoothed_data = convolve(t, kernel, mode='constant', cval=0.0)
+    if separable:
+        factor = gaussian_kernel_1d(neighboorhoodsize, sigma)
+        kernel = (factor, factor)
+    else:
+        kernel = gaussian_kernel(neighboorhoodsize, sigma)
 
-    salient_data = only_quantiles(smoothed_data, quant_range=0.005, fill=0, only_upper=True)
+    # the data is centered, smoothed and thresholded in stripes of rows with half the
+    # kernel height of rows above and below as halo, only the result has the full size.
+    # The quantiles are taken per row, every stripe is thresholded on its own.
+    mean = np.mean(data)
+    resolution = max(abs(np.max(data) - mean), abs(np.min(data) - mean)) * snap_precision if data.size > 0 else 0
+    halo = neighboorhoodsize // 2
+    n = len(data)
+
+    salient_data = np.empty(data.shape, dtype=np.result_type(data.dtype, float))
+    for start in range(0, n, stripe_rows):
+        end = min(start + stripe_rows, n)
+        lower = max(0, start - halo)
+        upper = min(n, end + halo)
+
+        smoothed_data = convolve_same(data[lower:upper] - mean, kernel)[start - lower:end - lower]
+        smoothed_data = snap(smoothed_data, resolution)
+        salient_data[start:end] = only_quantiles(smoothed_data, quant_range=0.005, fill=0, only_upper=True)
     salient_data[salient_data > 0] = 1
 
     return salient_data
@@ -312,18 +412,16 @@ def interestingness_measure(data, neighborhood=10, dist_fn=hellinger, bound_valu
 
     binarized_data = convolution_binarize(flipped_data, neighborhood)
 
-    interestingness = []
-    for i in range(len(binarized_data) - 1):
-        dst = 0
-        for j in range(1, 3):
-            low_idx = i - j
-            high_idx = i + j
-            if low_idx > -1:
-                dst += dist_fn(binarized_data[i], binarized_data[low_idx])
-            if high_idx < len(binarized_data):
-                dst += dist_fn(binarized_data[i], binarized_data[high_idx])
-        interestingness.append(dst)
-    interestingness = np.array(interestingness)
+    # distance of every row to the rows 1 and 2 above and below, band[k, i] = dist(i, i + k + 1)
+    n = len(binarized_data)
+    band = banded_distances(binarized_data, [1, 2], dist_fn)
+
+    interestingness = np.zeros(n)
+    for k, j in enumerate([1, 2]):
+        pairs = band[k, :max(n - j, 0)]
+        interestingness[j:] += pairs
+        interestingness[:max(n - j, 0)] += pairs
+    interestingness = interestingness[:max(n - 1, 0)]
 
     return interestingness, binarized_data
 
@@ -0,0 +1,50 @@
+import numpy as np
+
+from measures import convolution_binarize, gaussian_kernel, convolve_same
+
+
+# The separable and the 2D convolution of convolution_binarize only differ by
+# rounding errors, the binarized data has to be the same for both.
+
+def make_data():
+    rng = np.random.default_rng(0)
+
+    sparse = np.zeros((300, 500))
+    sparse[rng.random(sparse.shape) < 0.01] = 1
+
+    one_hot = np.zeros((300, 500))
+    one_hot[np.arange(300), rng.integers(0, 500, 300)] = 1
+
+    constant = np.full((300, 500), 0.7)
+
+    walk = np.cumsum(rng.normal(size=(300, 500)), axis=1)
+
+    return {'sparse': sparse, 'one-hot': one_hot, 'constant': constant, 'walk': walk}
+
+
+def test_separable_kernel():
+    kernel = gaussian_kernel(11, 2)
+    data = make_data()['walk']
+    factor = kernel[5] / kernel[5].sum()
+    assert np.allclose(convolve_same(data, (factor, factor)), convolve_same(data, kernel))
+
+
+def test_binarize_separable():
+    for name, data in make_data().items():
+        for neighborhood in [10, None]:
+            separable = convolution_binarize(data, neighborhood, separable=True)
+            direct = convolution_binarize(data, neighborhood, separable=False)
+            assert np.array_equal(separable, direct), name
+
+
+def test_binarize_stripes():
+    for name, data in make_data().items():
+        # stripes smaller than the kernel halo and not dividing the rows
+        for stripe_rows in [3, 64, 1000]:
+            assert np.array_equal(convolution_binarize(data, 10, stripe_rows=stripe_rows), convolution_binarize(data, 10)), name
+
+
+if __name__ == '__main__':
+    for test in [test_separable_kernel, test_binarize_separable, test_binarize_stripes]:
+        test()
+        print(f'{test.__name__} passed')
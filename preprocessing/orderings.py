@@ -79,11 +79,7 @@ def clustering_linkage(data, dist_func=normalized_euclidean, square_func=euclide
     if len(o.shape) != 2:
         return None
     
-    n, _ = o.shape
-    dist = np.zeros((n, n), dtype=float)
-    for i in range(n):
-        for j in range(i, n):
-            dist[i, j] = dist_func(o[i], o[j])
+    dist = upper_distances(o, dist_func)
     
     square_dist = square_func(dist)
     square_dist = np.nan_to_num(square_dist)
@@ -51,7 +51,7 @@ for model in "${models[@]}"; do
         fi
 
         # Extract data from the model
-        python dense-pixel-orderings.py -d "$dataset" -m "$model" -mp "$directory" -rp "$directory"
+        python dense-pixel-orderings.py -d "$dataset" -m "$model" -mp "$directory" -rp "$directory" -w "${WORKERS:-1}"
 
         # Fix permissions to standard user
         if [ ! -z "$HOST_UID" ] && [ ! -z "$HOST_GID" ]; then
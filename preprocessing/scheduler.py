@@ -0,0 +1,93 @@
+import os
+import time
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context, shared_memory
+
+from logger import logger
+
+
+# Runs the ordering families of all (stage, data block) pairs as independent jobs
+# on a process pool. Every block is copied once into shared memory and the workers
+# map it instead of receiving a pickled copy per job. The jobs read and write the
+# same checkpoint store as calculate_reordering_for_data, so finished families
+# are loaded instead of recomputed.
+
+# families that compare all pairs of rows, scheduled first
+quadratic_families = ['clustering', 'reduced-clustering']
+
+
+def share_array(data):
+    data = np.ascontiguousarray(data)
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+    return shm, (shm.name, data.shape, data.dtype.str)
+
+
+def limit_threads(threads):
+    # the workers share the cores, keep BLAS and OpenMP from starting a thread per core in each
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=threads)
+
+
+def run_job(family, shared, checkpoint_path):
+    from helpers import calculate_ordering_family
+
+    name, shape, dtype = shared
+    shm = shared_memory.SharedMemory(name=name)
+    data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        start_time = time.process_time()
+        family_results = calculate_ordering_family(family, data, checkpoint_path)
+        return family_results, time.process_time() - start_time
+    finally:
+        del data
+        shm.close()
+
+
+def job_cost(family, shape):
+    rows = shape[0]
+    cols = int(np.prod(shape[1:]))
+    if family in quadratic_families:
+        return rows * rows + rows * cols
+    return rows * cols
+
+
+def calculate_reorderings(blocks, workers):
+    # blocks: [stage, name, data, checkpoint_path], returns {stage: {name: [[name, scores, ordering], ...]}}
+    # with the orderings in the same order as calculate_reordering_for_data
+    from helpers import ordering_families
+
+    families = ['base', *ordering_families]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    shared_blocks = []
+    results = {}
+    try:
+        jobs = []
+        for stage, name, data, checkpoint_path in blocks:
+            shm, shared = share_array(data)
+            shared_blocks.append(shm)
+            results.setdefault(stage, {})[name] = [None] * len(families)
+            for position, family in enumerate(families):
+                jobs.append([stage, name, position, family, shared, checkpoint_path])
+        jobs.sort(key=lambda job: job_cost(job[3], job[4][1]), reverse=True)
+
+        logger.info(f'Running {len(jobs)} ordering jobs on {workers} workers')
+
+        context = get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=limit_threads, initargs=(threads,)) as executor:
+            futures = {executor.submit(run_job, family, shared, checkpoint_path): [stage, name, position, family] for stage, name, position, family, shared, checkpoint_path in jobs}
+            for future in as_completed(futures):
+                stage, name, position, family = futures[future]
+                family_results, needed_time = future.result()
+                results[stage][name][position] = family_results
+                logger.info(f'{stage} - {name} - {family}: {len(family_results)} orderings in {np.round(needed_time, 3)} seconds')
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+    return {stage: {name: [r for family_results in v for r in family_results] for name, v in part.items()} for stage, part in results.items()}